@@ -64,10 +64,35 @@ Negative mode formula must now have an odd number of protons - this means they h
 #####
 Version 6 - September 2020
 Add support for P for Positive mode - fix broken code.
+#####
+Version 7
+Adds a vectorised (NumPy) formula engine, see vector_form_chunks in the ProcessingModule. Set vectorised = False to use the original loops.
+Each carbon number is built as a block of integer arrays and the ratio, N rule/adduct, heteroatom and mass window rules applied as masks.
+It gives exactly the same dictionaries as the loops, but is orders of magnitude faster when broad elemental limits are used.
+Windows, and slices of the carbon range within each window, can be spread over a pool of processes (parallel = True).
+Slices are sized by the number of candidates they have to test and the most expensive go first. The output is the same for any number of workers.
+The run section is now under if __name__ == "__main__" so that the worker processes do not re-run it.
+Dictionary windows are cached (usecache = True), keyed by a hash of the mode, window, elemental limits, atomic masses and ratio rules.
+A window whose key is already in the cache is copied rather than recalculated. The atomic masses and the elemental limits have moved to the
+ProcessingModule, so that 1-FormulaAssignment can ask the cache for the dictionaries matching the same limits.
+Dictionaries are also written in a binary format (binarydictionaries = True) - a .npy file of typed records: float64 mass and abundance,
+int16 element counts and an integer homo code. 1-FormulaAssignment memory-maps these rather than parsing the csv files.
+Formulae are now streamed in typed chunks (chunkrows at most), sorted by mass in runs on disk and merged (an external merge sort).
+This fixes the old text sort of masses (np.array of mixed rows gave a string array), and wide limits now run in bounded memory.
+A mass directed (branch and bound) mode, massbounded = True, grows each composition one element at a time and only visits the counts
+which can still reach the mass window given the mass so far, rather than testing the whole elemental box. Same formulae, far less work at high mass.
+Both modes can now be generated in one go (answer "both"). With sharedneutral = True the neutral molecules are enumerated once and each
+adduct (see adductdict in the ProcessingModule) derived from them, so the formula space is not enumerated once per mode.
+Each formula now also carries the mass and relative abundance of its main isotopologues (13C1, 13C2, 34S, 18O, 15N and 41K, see isotopologues in the
+ProcessingModule), as extra columns after homoval. Isotope peaks can then be looked up in the dictionary rather than worked out for every spectrum.
+The fixed windows give very uneven dictionaries (a few hundred formulae at 100 m/z, many thousands at 700 m/z). With adaptivewindows = True the
+formulae are instead cut into windows of about equal size. Each folder of dictionaries now has a manifest.csv listing the file, bounds and size of each window.
+The vectorised engine counts how many candidates each rule tests and rejects, and prints them per window (rulestatistics = True), so elementallimits
+can be tuned from data. With adaptiverules = True the per formula rules are run strongest first, by their measured selectivity.
 """
 
 import numpy as np
-import sys, os
+import sys, os, shutil, tempfile
 
 """
 # We import also the FTMSVizProcessingModule which contains a few useful functions.
@@ -90,23 +115,22 @@ from datetime import datetime
 #This is our list of masses - i.e. the center point of each output csv file. For ease/speed, we chunk our lists into 100 m/z blocks.
 masses  = [150,250,350,450,550,650,750]
 dictionarywindow = 50 # the window is plus or minus this value. So 50 = 100 m/z window. 
+vectorised = True # True uses the NumPy formula engine in the ProcessingModule - same formulae as the loops below, but far faster for broad limits. False uses the original loops.
+massbounded = True # True only visits the element counts which can still land in the mass window (branch and bound). Same formulae, much less work for high mass windows. Needs vectorised = True.
+parallel = True # True spreads the windows (and slices of their carbon range) over a pool of processes. Needs vectorised = True. Output is identical to a serial run.
+nworkers = None # number of processes for parallel generation. None uses all of your cores.
+usecache = True # True keeps every dictionary window in a cache, keyed by the mode, limits, atomic masses and ratio rules. Windows already in the cache are not recalculated.
+cachepath = path+"FormulaCache/" # where the cached dictionaries are kept. 1-FormulaAssignment looks here too.
+binarydictionaries = True # True also writes each dictionary as a binary (.npy) file, which 1-FormulaAssignment memory-maps instead of parsing the csv.
+chunkrows = 1000000 # the most formulae held in memory at once. Formulae are sorted by mass in runs of this size on disk, then merged (an external merge sort).
+tempdir = None # where the sorted runs are kept while generating. None uses your system's temporary directory.
+sharedneutral = True # when generating both modes, True enumerates the neutral molecules once and derives the [M-H]-, [M+H]+, [M+Na]+ and [M+K]+ ions from them. Needs vectorised = True. Same dictionaries as generating each mode alone.
+adaptivewindows = False # True cuts the formulae between the first and last window into windows holding about the same number of formulae each (at whole m/z values), rather than writing the fixed windows above. The fixed windows (which must then sit end to end, as they do by default) are still what is cached.
+nwindows = None # number of adaptive windows. None gives as many as there are masses.
+rulestatistics = False # True prints, for each window calculated, how many candidate formulae each rule tested and rejected - useful for tuning elementallimits. Needs vectorised = True (not counted for shared neutral runs).
+adaptiverules = False # True runs the per formula rules (N rule, heteroatoms, mass window) in order of their measured selectivity, strongest first. Same formulae either way.
 
 
-#This section checks what ionisation mode you wish to generate a dictionary for. ### Future versions, move this code to the ProcessingModule? -wk
-mode = input("Do you want a dictionary of positive or negative mode ions? ")
-while mode.lower() != "negative" and mode.lower() != "positive":
-    print("Please enter either negative or positive")
-    mode = input("Do you want a dictionary of positive or negative mode ions? ")
-else:
-    if mode.lower() == "negative":
-        mode = "negative" 
-    elif mode.lower() == "positive":
-        mode = "positive"
-        
-startTime = datetime.now()
-
-print("Elemental formulae limits are coded into the script. Please double check they are suitable for your application.")
-
 #This calculates the mass of a given formulae - for an ION
 def getmass(c,h,o,n,s,p,na,k):
     massC = chemdict['C'][0] * c
@@ -184,6 +208,7 @@ def pos_adduct_checker(h,n,na,k):
 	return logicstatement
 
 #Calculates formulae in positive mode for given limits. Includes possibility of Sodium and Potassium adducts. 
+#The formulae are handed on as typed chunks (see formuladtype in the ProcessingModule) of at most chunkrows formulae, in loop order.
 def pos_form_calc(maxC, maxH, maxO, maxN, maxS,maxP, maxNa, maxK, low, high):
     maxC = min((int(high) / 12), maxC) #here we say the max carbon count has to be the smaller of the total mass/12 or predefined maxC
     maxH = min((maxC * 4), maxH) #max hydrogen count is the smaller of 4 times the number of carbons or the predefined max hydrogen number.
@@ -193,7 +218,6 @@ def pos_form_calc(maxC, maxH, maxO, maxN, maxS,maxP, maxNa, maxK, low, high):
     maxP = maxP + 1
     maxNa = maxNa + 1
     maxK = maxK + 1
-    allpossformula = []
     allposs = []
     for c in range(int(maxC))[1:]: #obviously our molecules contain at least 1 C and 1 H
         for h in range(int(maxH))[1:]: #Based on seven golden rules, a minimum/maximum H/C Ratio - should be 0.125 to 3.1 for 99.7% of molecules, but inc to 4 to represent ESI adduct possibilities
@@ -216,11 +240,12 @@ def pos_form_calc(maxC, maxH, maxO, maxN, maxS,maxP, maxNa, maxK, low, high):
                                                         homo,homoval = homochecker(o,n,s,p)
                                                         if 0 < float(homoval) < (c*1.3) : #this checker ensures that there are a max 1.3*C heteroatoms. I.e. C10H20O13 is OK, but C10H20O14 is not OK. May need adjustment. 
                                                             if low < mass < high:
-                                                                formula = "C%iH%iO%iN%iS%iP%iNa%iK%i" % (c,h,o,n,s,p,na,k) 
                                                                 abundance = getabun(c,h,o,n,s)
-                                                                allposs.append([mass,abundance,c,h,o,n,s,p,na,k,homo,homoval])
-                                                                allpossformula.append([formula])
-    return allposs   
+                                                                allposs.append((mass,abundance,c,h,o,n,s,p,na,k,FTPM.homocode(o,n,s,p),homoval))
+                                                                if len(allposs) == chunkrows: #hand on a typed chunk, so we never hold more than chunkrows formulae
+                                                                    yield FTPM.formulachunk(allposs,chemdict)
+                                                                    allposs = []
+    yield FTPM.formulachunk(allposs,chemdict)
 
 #Checks N rule (and #H) to see if assigned formula is logical for a negative mode ion. 
 def neg_nhchecker(h,n):
@@ -233,6 +258,7 @@ def neg_nhchecker(h,n):
 	return logicstatement
 
 #Calculates the negative mode ion for given limits	
+#The formulae are handed on as typed chunks (see formuladtype in the ProcessingModule) of at most chunkrows formulae, in loop order.
 def neg_form_calc(maxC, maxH, maxO, maxN, maxS,maxP, low, high):
 	maxC = min((int(high) / 12), maxC) #here we say the max carbon count has to be the smaller of the total mass/12 or predefined maxC
 	maxH = min((maxC * 4), maxH) #max hydrogen count is the smaller of 4 times the number of carbons or the predefined max hydrogen number.
@@ -240,7 +266,6 @@ def neg_form_calc(maxC, maxH, maxO, maxN, maxS,maxP, low, high):
 	maxN = maxN + 1
 	maxS = maxS + 1
 	maxP = maxP + 1
-	allpossformula = []
 	allposs = []
 	for c in range(int(maxC))[1:]: #obviously our molecules contain at least 1 C and 1 H
 		for h in range(int(maxH))[1:]: #Based on seven golden rules, a minimum/maximum H/C Ratio - should be 0.125 to 3.1 for 99.7% of molecules, but inc to 4 to represent ESI adduct possibilities
@@ -261,104 +286,129 @@ def neg_form_calc(maxC, maxH, maxO, maxN, maxS,maxP, low, high):
 												homo,homoval = homochecker(o,n,s,p)
 												if 0 < float(homoval) < (c*1.3) : #this checker ensures that there are a max 1.3*C heteroatoms. I.e. C10H20O13 is OK, but C10H20O14 is not OK. May need adjustment. 
 													if low < mass < high:
-														formula = "C%iH%iO%iN%iS%iP%iNa%iK%i" % (c,h,o,n,s,p,0,0) 
 														abundance = getabun(c,h,o,n,s)
-														allposs.append([mass,abundance,c,h,o,n,s,p,0,0,homo,homoval])
-														allpossformula.append([formula])
-	return allposs    	
-
-
-#atomic masses taken from Pure Appl. Chem. 2016; 88(3): 265–291, Atomic Weights of the Elements 2013, doi: 10.1515/pac-2015-0305
-#Atomic Masses taken from AME2012 - Chinese Physics C 36 (2012)  1603-2014, Wang, Audi, Wapstra, Kondex, MacCormic, Xu, and Pfeiffer. doi: 10.1088/1674-1137/36/12/003
-#isotoptic abundances from Pure Appl. Chem. 2016; 88(3): 293–306, Isotopic compositions of the elements 2013 (IUPAC Technical Report), doi: 10.1515/pac-2015-0503
-#electron mass from NIST http://physics.nist.gov/cgi-bin/cuu/Value?meu|search_for=electron+mass
-chemdict = {'H':(1.007825, 0.99984),
-            'C':(12.000000, 0.98892),
-            'N':(14.003074, 0.99634),
-            'O':(15.994915, 0.99762),
-            'Na':(22.989769, 1.0),
-            'P':(30.973763,1.0),
-            'S':(31.972071, 0.95041),
-            'Cl':(34.968853, 0.75765),
-            'K':(38.963706, 0.93258),
-            'Br':(78.918338, 0.50686),
-            'e':(0.0005485799, 1.0)} 
-
-#################################################
-# This section is important.
-# Here you define your elemental limits.
-# In short - if you have tight limits, you'll get faster results.
-# Broad limits - longer calculations and risk of multiple possible assignments in the next script. Not tested fully at high limits.
-# CHONS limits were derived from the literature, however the following negative mode limits have been  tightened for the samples our group looks at
-# for example, fulvic acids and scotch whisky. 
-# See, for example, Kew, W., Goodall, I., Clarke, D., Uhrin, D.
-#                   "Chemical Diversity and Complexity of Scotch Whisky as Revealed by High-Resolution Mass Spectrometry" 
-#                   J. Am. Soc. Mass Spectrom., 2016. doi:10.1007/s13361-016-1513-y
-#################################################
+														allposs.append((mass,abundance,c,h,o,n,s,p,0,0,FTPM.homocode(o,n,s,p),homoval))
+														if len(allposs) == chunkrows: #hand on a typed chunk, so we never hold more than chunkrows formulae
+															yield FTPM.formulachunk(allposs,chemdict)
+															allposs = []
+	yield FTPM.formulachunk(allposs,chemdict)
+
+
+#The atomic masses (chemdict) and the elemental limits (elementallimits) now live in the FTMSVizProcessingModule,
+#so that 1-FormulaAssignment can find the cached dictionary for the same limits. Change your limits there.
+chemdict = FTPM.chemdict
 
 def elementallimits(low,high):
-    if mode == "negative":
-        if high < 500:
-            maxC = 29 #numbers based on paper
-            maxH = 72
-            maxO = 18
-            maxN = 0
-            maxS = 2#1 #max S found in Whisky was 1
-            maxP = 0
-            maxNa = 0
-            maxK = 0
-        elif 500 <= high <= 1000:
-            maxC = 66
-            maxH = 126
-            maxO = 27
-            maxN = 0
-            maxS = 2#1 #max S found in Whisky was 1 
-            maxP = 0
-            maxNa = 0
-            maxK = 0
-            
-    elif mode == "positive": #these numbers are quite broad, based on seven golden rules (etc). on  you may need to tailor to your appication - many possible formulae!
-        if high < 500:
-            maxC = 29
-            maxH = 72
-            maxO = 18
-            maxN = 0#10
-            maxS = 0#7
-            maxP = 0
-            maxNa = 1
-            maxK = 0
-        elif 500 <= high < 1000:
-            maxC = 66
-            maxH = 126
-            maxO = 27
-            maxN = 0#10
-            maxS = 0#4
-            maxP = 0
-            maxNa = 1
-            maxK = 0
-    return maxC, maxH, maxO, maxN, maxS,maxP, maxNa, maxK
+    return FTPM.elementallimits(low,high,mode)
     
 import pandas as pd
 #Finally, this bit runs all of the code and saves the output dictionaries as csv files.     
-for i in masses:
-    low = i - dictionarywindow
-    high = i + dictionarywindow
-    print("Calculating formulae between " +str(low) + " and " +str(high) + " m/z")
-    maxC, maxH, maxO, maxN, maxS,maxP, maxNa, maxK = elementallimits(low,high)
-    maxlimstring = "C" +str(maxC) + " H"+str(maxH) + " N"+str(maxN) + " O"+str(maxO) +" S"+str(maxS)+" P"+str(maxP)
-    if mode == "negative":
-        allposs=neg_form_calc(maxC, maxH, maxO, maxN, maxS,maxP, low,high)
-    elif mode == "positive":
-        allposs=pos_form_calc(maxC, maxH, maxO, maxN, maxS,maxP, maxNa,maxK,low,high)
-        maxlimstring = maxlimstring + " Na"+str(maxNa) +" K"+str(maxK)
-    x = np.array(allposs)
-    x = x[np.argsort(x[:,0])]
-    filepathtosave = path+"FormulaDictionaries/"+str(mode[:3])
-    df = pd.DataFrame(x,columns=["mass","abundance","C","H","O","N","S","P","Na","K","homo","homoval"])
-    FTPM.make_sure_path_exists(filepathtosave) #Makes sure the output directory exists, and creates it if not.
-    df.to_csv(filepathtosave+"\\"+"dict"+str(low)+".csv",index=False)
-    #np.savetxt(filepathtosave+"\\"+"dict"+str(low)+".csv",x,delimiter=',',fmt="%s")
-    if i == masses[-1]:
-        print("Max Elemental Limits were:")
-        print(maxlimstring)
+#It only runs when the script is run directly, so that the processes used for parallel generation don't re-run it (or ask for the mode again).
+if __name__ == "__main__":
+    #This section checks what ionisation mode you wish to generate a dictionary for. ### Future versions, move this code to the ProcessingModule? -wk
+    mode = input("Do you want a dictionary of positive, negative or both mode ions? ")
+    while mode.lower() != "negative" and mode.lower() != "positive" and mode.lower() != "both":
+        print("Please enter either negative, positive or both")
+        mode = input("Do you want a dictionary of positive, negative or both mode ions? ")
+    else:
+        if mode.lower() == "negative":
+            modes = ["negative"]
+        elif mode.lower() == "positive":
+            modes = ["positive"]
+        elif mode.lower() == "both":
+            modes = ["negative","positive"]
+            
+    startTime = datetime.now()
+    
+    print("Elemental formulae limits are coded into the script. Please double check they are suitable for your application.")
+
+    windows, cached = {}, {}
+    for mode in modes:
+        windows[mode] = [(i - dictionarywindow, i + dictionarywindow, elementallimits(i - dictionarywindow, i + dictionarywindow)) for i in masses]
+        cached[mode] = [FTPM.cacheddictionary(cachepath,mode,low,high,limits,chemdict) if usecache else None for low, high, limits in windows[mode]]
+    runpath = tempfile.mkdtemp(dir=tempdir)
+    try:
+        calculatedruns = {mode:{} for mode in modes}
+        calculatedstats = {mode:{} for mode in modes}
+        if vectorised and sharedneutral and len(modes) > 1:
+            tocalculate = [j for j in range(len(masses)) if any(cached[mode][j] is None for mode in modes)]
+            if len(tocalculate) > 0:
+                print("Calculating formulae for " +str(len(tocalculate)) + " windows between " +str(windows[modes[0]][tocalculate[0]][0]) + " and " +str(windows[modes[0]][tocalculate[-1]][1]) + " m/z from shared neutral molecules")
+                neutralruns = FTPM.neutral_form_runs({mode:[windows[mode][j] for j in tocalculate] for mode in modes},chemdict,runpath,nworkers if parallel else 1,chunkrows)
+                for mode in modes:
+                    calculatedruns[mode] = dict(zip(tocalculate,neutralruns[mode]))
+        elif vectorised and parallel:
+            for mode in modes:
+                tocalculate = [j for j in range(len(masses)) if cached[mode][j] is None]
+                if len(tocalculate) > 0:
+                    print("Calculating " +mode + " mode formulae for " +str(len(tocalculate)) + " windows between " +str(windows[mode][tocalculate[0]][0]) + " and " +str(windows[mode][tocalculate[-1]][1]) + " m/z in parallel")
+                    windowstats = [FTPM.newrulestats() for j in tocalculate]
+                    calculatedruns[mode] = dict(zip(tocalculate,FTPM.parallel_form_runs([windows[mode][j] for j in tocalculate],mode,chemdict,runpath,nworkers,chunkrows,massbounded,adaptiverules,windowstats)))
+                    calculatedstats[mode] = dict(zip(tocalculate,windowstats))
+        for mode in modes: #mode is a global here, as getmass in the loop calculators uses it
+            filepathtosave = path+"FormulaDictionaries/"+str(mode[:3])
+            FTPM.make_sure_path_exists(filepathtosave) #Makes sure the output directory exists, and creates it if not.
+            windowdictionaries, manifest = [], []
+            for j, i in enumerate(masses):
+                low, high, limits = windows[mode][j]
+                maxC, maxH, maxO, maxN, maxS,maxP, maxNa, maxK = limits
+                maxlimstring = "C" +str(maxC) + " H"+str(maxH) + " N"+str(maxN) + " O"+str(maxO) +" S"+str(maxS)+" P"+str(maxP)
+                if mode == "positive":
+                    maxlimstring = maxlimstring + " Na"+str(maxNa) +" K"+str(maxK)
+                if adaptivewindows: #the fixed windows are only a step on the way, so they are kept with the runs
+                    csvfile = os.path.join(runpath,mode[:3]+"dict"+str(low)+".csv")
+                    npyfile = FTPM.binarydictionarypath(csvfile)
+                else:
+                    csvfile = filepathtosave+"\\"+"dict"+str(low)+".csv"
+                    npyfile = filepathtosave+"\\"+"dict"+str(low)+".npy" if binarydictionaries else None
+                if cached[mode][j] is not None:
+                    print(mode.capitalize() + " mode formulae between " +str(low) + " and " +str(high) + " m/z are already in the cache - not recalculating")
+                    if adaptivewindows: #read straight from the cache
+                        csvfile = cached[mode][j]
+                    else:
+                        shutil.copyfile(cached[mode][j],csvfile)
+                        if binarydictionaries and os.path.isfile(FTPM.binarydictionarypath(cached[mode][j])):
+                            shutil.copyfile(FTPM.binarydictionarypath(cached[mode][j]),npyfile)
+                        elif binarydictionaries:
+                            FTPM.loaddictionary(csvfile)
+                    rows = len(FTPM.loaddictionary(csvfile))
+                    for run in calculatedruns[mode].get(j,[]): #calculated alongside the other mode, but not needed
+                        os.remove(run)
+                else:
+                    if j in calculatedruns[mode]:
+                        runs = calculatedruns[mode][j]
+                    else:
+                        print("Calculating " +mode + " mode formulae between " +str(low) + " and " +str(high) + " m/z")
+                        if vectorised:
+                            calculatedstats[mode][j] = FTPM.newrulestats()
+                            chunks = FTPM.vector_form_chunks(maxC, maxH, maxO, maxN, maxS,maxP, maxNa,maxK,low,high,mode,chemdict,chunkrows,massbounded,adaptiverules,calculatedstats[mode][j])
+                        elif mode == "negative":
+                            chunks = neg_form_calc(maxC, maxH, maxO, maxN, maxS,maxP, low,high)
+                        elif mode == "positive":
+                            chunks = pos_form_calc(maxC, maxH, maxO, maxN, maxS,maxP, maxNa,maxK,low,high)
+                        runs = FTPM.sortedruns(chunks,chunkrows,runpath,mode[:3]+"dict"+str(low))
+                    rows = FTPM.writedictionary(FTPM.mergeruns(runs,chunkrows),FTPM.runrows(runs),csvfile,npyfile)
+                    for run in runs: #the sorted runs are no longer needed once merged
+                        os.remove(run)
+                    if usecache:
+                        FTPM.savecacheddictionary(csvfile,npyfile,cachepath,mode,low,high,limits,chemdict)
+                    if rulestatistics and j in calculatedstats[mode]:
+                        print("Candidate formulae tested and rejected by each rule between " +str(low) + " and " +str(high) + " m/z:")
+                        print(FTPM.rulestatsreport(calculatedstats[mode][j]))
+                windowdictionaries.append(csvfile)
+                manifest.append(("dict"+str(low)+".csv",low,high,rows))
+                if i == masses[-1]:
+                    print("Max " + mode + " mode Elemental Limits were:")
+                    print(maxlimstring)
+            if adaptivewindows: #now cut the whole mass range into windows of about equal size
+                manifest = []
+                for low, high, rows in FTPM.equalcountwindows(windowdictionaries,masses[0]-dictionarywindow,masses[-1]+dictionarywindow,nwindows or len(masses),chunkrows):
+                    csvfile = filepathtosave+"\\"+"dict"+str(low)+".csv"
+                    npyfile = filepathtosave+"\\"+"dict"+str(low)+".npy" if binarydictionaries else None
+                    FTPM.writedictionary(FTPM.windowblocks(windowdictionaries,low,high,chunkrows),rows,csvfile,npyfile)
+                    manifest.append(("dict"+str(low)+".csv",low,high,rows))
+                print(mode.capitalize() + " mode formulae written as " + str(len(manifest)) + " windows of about " + str(manifest[0][3]) + " formulae each")
+            FTPM.writemanifest(filepathtosave+"\\"+"manifest.csv",manifest)
         print("Time taken to calculate was " + str(datetime.now() - startTime))
+    finally:
+        shutil.rmtree(runpath,ignore_errors=True)
@@ -34,7 +34,7 @@ That means the assigned formulae may be IONIC formulae, and this needs proper re
 The peak list is read in, and Kendrick mass properties calculated for CH2 unit.
 Z stars are calculated, and homologous series with a minimum (user defined) number of members are grouped and checked against the formulae lists.
 User definied errors - both relative (ppm) and absolute (Da/Th) - are used to limit false positives.
-Unassigned peaks are then checked against the OH2, and finally H2 Kendrick mass units. NB: More mass units could readily be added.
+Unassigned peaks are then checked against the OH2, and finally H2 Kendrick mass units. More mass units can be added in kendrickpasses.
 Remaining unassigned peaks are then checked against the assigned peaks for being isotopologues.
     i.e. For unassigned peak X m/z , is there a peak at X - 1.003355 m/z? If so, X is likely the 13C isotopologue.
     This method could be expanded in a future version for more isotope peaks. Or a fuller re-write would check for isotope peaks on the initial assignment to improve accuracy.
@@ -63,14 +63,44 @@ Also cut out lots of unused functions (see v0.1 for them)
 -Version 0.3 - Isotopes and Other Kendrick Mass classes?
 
 - We now calculate 13C isotopologues. Error is not calculated. Other isotopes can be added if need be.
+
+- Dictionaries are now typed arrays sorted by mass (memory-mapped binary dictionaries). The candidates for a peak are found by binary search
+over the mass column (FTPM.dictionaryrange), not by scanning the whole dictionary.
+- With batchassign = True all the peaks of a pass are matched in one vectorised interval join (FTPM.massjoin), with the same thresholds.
+- Dictionaries are no longer all loaded at start up. Each window is loaded when a peak first needs it, and at most dictionarycachesize are kept.
+- The dictionary windows form one mass index (FTPM.massindex), read from the manifest 0-FormulaGenerator writes. Peaks are no longer limited to
+100-700 m/z, and a peak near a window edge now also sees the candidates in the next window.
+- Isotopologues are found by a sorted search (FTPM.isotopejoin) for every isotopologue in isotopesearched in one pass, within isothreshold (Da) and isothreshppm,
+against the isotopologue masses the dictionaries hold for each hit. The error is now calculated, and the 13C2 and 18O element counts are corrected.
+- Kendrick properties are calculated as array operations (FTPM.kendrickproperties), and series are stripped with a grouped count, not a per row lambda.
+- The assignment passes are set by kendrickpasses. The peaks are kept in one peak state table, and each peak's candidates are looked up once and
+reused by every pass - only the series grouping changes. The isotopologue search now also excludes the peaks assigned in the last pass.
+- With nworkers > 1 a folder of peaklists is assigned over a pool of processes. The dictionaries are loaded once into shared memory, which every worker
+reads without copying, and each peaklist's results are written as soon as it is done.
+- With servicemode = True the script runs as a local HTTP service (serve). The dictionaries are loaded once and stay in memory, and peaklists
+POSTed to it get their hits, isohits and nohits back straight away.
+- With streampeaklists = True each peaklist is read and assigned in m/z ordered chunks (streambody), and the results written chunk by chunk.
+Hits near the top of a chunk are carried into the next for the isotopologue search.
+- With stagemetrics = True each stage of the assignment is measured (wall time, peak memory, rows in and out, candidates scanned), and written as json
+for each peaklist, with a summary for the batch.
+- With outputformat = "parquet" the hits, isohits and nohits are written as one typed columnar file with a Status column (FTPM.writeresults),
+which the readers in the ProcessingModule (and so the plotting scripts) read directly. "both" also writes the csvs.
+- With candidatecache = True every peak-formula pair within candidatethreshold and candidatethreshppm is saved for each peaklist (cachedcandidates).
+Re-running with other thresholds, maxgap or minKMDseries then re-filters the saved candidates instead of searching the dictionaries.
+- With generatemissing = True dictionary windows a peaklist needs which have not been made are generated here (coverwindows), with the same
+engine and elementallimits as 0-FormulaGenerator, and kept in the formula cache for later runs.
+- Candidates and hits are carried as element counts through all the passes - the candidates as typed arrays of dictionary records ordered by peak
+(FTPM.newcandidates), which each pass picks its peaks' rows out of. The DBE, Formula and HeteroClass of the hits (formulacolumns), and the
+isotopologue formulae, are built once, as whole columns (FTPM.formulastrings etc.), for only the rows which are written.
+- The isotope check reads each hit's isotopologue masses from the dictionaries rather than working them out for every spectrum. With
+isoabundancetolerance set, an isotopologue's intensity must also be close to that expected from its hit and the dictionaries' relative abundances.
 """
 #Here we import our functions.
-#import numpy as np
+import numpy as np
 import pandas as pd
 from datetime import datetime
-from collections import Counter
-from itertools import dropwhile
-import sys, re, os
+from functools import lru_cache
+import sys, os, json
 
 """
 # We import also the FTMSVizProcessingModule which contains a few useful functions.
@@ -95,16 +125,20 @@ else: #if running in ipython
 
 
 #This section checks what ionisation mode you wish to generate a dictionary for. ### Future versions, move this code to the ProcessingModule? -wk
-ionisationmode = input("Is your data positive or negative mode? ")
-while ionisationmode.lower() != "negative" and ionisationmode.lower() != "positive":
-    print("Please enter either negative or positive")
+#It is asked when the script is run (see the bottom of the script). Worker processes for parallel assignment are given it by batchinit.
+def askmode():
     ionisationmode = input("Is your data positive or negative mode? ")
-else:
-    if ionisationmode.lower() == "negative":
-        ionisationmode = "negative"
-    elif ionisationmode.lower() == "positive":
-        ionisationmode = "positive"
+    while ionisationmode.lower() != "negative" and ionisationmode.lower() != "positive":
+        print("Please enter either negative or positive")
+        ionisationmode = input("Is your data positive or negative mode? ")
+    else:
+        if ionisationmode.lower() == "negative":
+            ionisationmode = "negative"
+        elif ionisationmode.lower() == "positive":
+            ionisationmode = "positive"
+    return ionisationmode
 
+ionisationmode = None
 startTime = datetime.now()
 
 #Define some parameters for our assignment thresholds.
@@ -113,31 +147,104 @@ maxgap = 0.0003 #gap between KMDs for separating series. Units are Da, hence the
 threshold = 0.005 #Error threshold for formulae in Da - i.e. absolute error threshold.
 threshppm = 1.0 # Error threshold for formulae in ppm - i.e. relative error threshold.
 #isothresh = 0.0001 # threshold for isotope peak checker #Function not currently active
-highlmt = 800 #highest mass to import from peaklist, in case your peak list extends higher than you have generated formulae for.
+highlmt = 800 #highest mass to import from peaklist, in case your peak list extends higher than you have generated formulae for (see also generatemissing).
 minKMDseries = 1 #minimum number of peaks in a single homologous series to assign by zstar approach # 3 seems a good number.
-precisionfactor = 1000#0#0000 # This is a work in progress. THis is used for isotope hunting. A value of 1000 = 1.003355*1000, is equal to a 1 mDa error threshold, at 500 m/z this is 0.2 ppm.
+precisionfactor = 1000#0#0000 # Used by multiplyprecision. A value of 1000 = 1.003355*1000, is equal to a 1 mDa error threshold, at 500 m/z this is 0.2 ppm.
+isothreshold = 0.001 # Error threshold for isotopologues in Da - an unassigned peak must be within this of a hit's theoretical mass plus the isotope shift.
+isothreshppm = 1.0 # Error threshold for isotopologues in ppm. Both isotope thresholds must be met.
+isoabundancetolerance = None # e.g. 3.0 only keeps isotopologues whose intensity is within a factor of 3 of that expected from their hit's intensity and
+# the relative abundance of the isotopologue in the dictionary. None does not check intensities.
 
 CH2 = (14.0, 14.01565) #kendrick nominal mass, kendrick exact mass
 OH2 = (18.0, 18.010565) #kendrick nominal mass, kendrick exact mass
 CO2 = (44.0, 43.989183) #as above
 H2 = (2.0, 2.01565) #as above
 Oseries = (16.0, 15.994915) #as above
-## Future version - define a function to calculate these on the fly? - wk
+kendrickpasses = [CH2, OH2, H2] #Kendrick bases for the assignment passes, in order. Peaks unassigned by one pass go on to the next. e.g. add CO2 or Oseries.
+
+isotopesearched = ["13C1","13C2","34S","18O","15N"] # the isotopologues looked for, by the names of their columns in the dictionaries (see FTPM.isotopologues).
+# Their masses and abundances are read from the dictionaries. Isotopes of C, N, O and S can be looked for.
+
+usecache = True # True looks in the formula cache (see 0-FormulaGenerator) for the dictionaries matching the elemental limits in the ProcessingModule first.
+cachepath = path+"FormulaCache/" # must match cachepath in 0-FormulaGenerator
+generatemissing = False # True generates any dictionary window a peaklist needs which has not been made (see coverwindows), in this process, and keeps it in
+# the formula cache - so a new mass range costs one generation, once. Raise highlmt to use it for higher masses.
+generatedwidth = 100 # width (m/z) of the windows generated on demand, as the 100 m/z windows of 0-FormulaGenerator.
+generatedwindows = {"negative":[],"positive":[]} # the windows generated (or found in the cache) on demand, as (filename, low, high).
+batchassign = True # True matches all the peaks of a z* pass against the dictionaries in one vectorised join (FTPM.massjoin), rather than one peak at a time in form_checker. Same assignments.
+
+servicemode = False # True runs a local assignment service (see serve) instead of assigning the InputPeaklist folder. The dictionaries are loaded once and kept warm.
+serviceaddress = ("127.0.0.1", 8000) # where the service listens. Keep it local - there is no authentication.
+candidatecache = False # True keeps the raw candidates of each peaklist (see cachedcandidates), so re-running it with new thresholds, maxgap or minKMDseries only re-filters them.
+candidatethreshold = 0.01 # widest error threshold (Da) kept in the candidate cache - threshold can be tuned up to this without a new search.
+candidatethreshppm = 5.0 # widest error threshold (ppm) kept in the candidate cache - likewise for threshppm.
+candidatecachepath = path+"CandidateCache/"
+outputformat = "csv" # "csv" writes XXX-hits.csv, XXX-isohits.csv and XXX-nohits.csv. "parquet" writes one typed columnar file, XXX-results.parquet, with a Status
+# column (hit, isohit or nohit) - smaller and faster to read, and read directly by the ProcessingModule readers. Needs pyarrow. "both" writes both.
+streampeaklists = False # True reads each peaklist in m/z ordered chunks of streamchunk peaks and writes the results chunk by chunk, so memory stays bounded for very large peaklists.
+streamchunk = 100000 # peaks per chunk when streaming. Streaming always writes csvs.
+stagemetrics = False # True measures each stage of the assignment (wall time, peak memory, rows in and out, candidates scanned) and writes them as json
+# alongside each peaklist's results (XXX-metrics.json), with a summary of the batch (batch-metrics.json). Tracing the memory slows the assignment down.
+metrics = None # the stage metrics of the peaklist being assigned, if stagemetrics is on (see godo).
+nworkers = 1 # number of processes assigning peaklists in parallel, one peaklist each at a time. 1 assigns them one after another here. None uses all of your cores.
+dictionarycachesize = 4 # the most dictionary windows held at once. Windows are loaded when a peak first needs them, and the least recently used dropped.
+
+#This builds the mass index over every dictionary window generated for a mode - the windows and their bounds come from the manifest written
+#by 0-FormulaGenerator (or from the dictionaries themselves), so any number of windows, up to any mass, can be used without changing this script.
+#For each window, the cached dictionary matching our elemental limits is used if there is one, otherwise the one in the dictionarypath.
+#Double check you have made your correct formulae list prior to start of this function!
+#In a worker process for parallel assignment, the index built by the main process is used (see batchinit).
+@lru_cache(maxsize=None)
+def dictionaryindex(mode):
+    if sharedindex is not None:
+        return sharedindex
+    windows = []
+    for filename, low, high in FTPM.dictionarywindows(dictionarypath+mode[:3]+"\\"):
+        if usecache:
+            cached = FTPM.cacheddictionary(cachepath,mode,int(low),int(high),FTPM.elementallimits(int(low),int(high),mode),FTPM.chemdict)
+            if cached is not None:
+                filename = cached
+        windows.append((filename, low, high))
+    windows = windows + generatedwindows[mode]
+    if len(windows) == 0 and not generatemissing:
+        raise IOError("No " + mode + " mode formula dictionaries found in " + dictionarypath + " - run 0-FormulaGenerator first")
+    return FTPM.massindex(windows)
 
 #This section loads up our formulae lists, here known as dictionaries (however they are not pythonic dictionaries)
-#We only need load them up once, so the try statement checks if we have loaded yet. Reading in can take 5-10 seconds
-#Double check you have made your correct formulae list prior to start of this function!
-try:
-    dict100
-except NameError:
-    #dictnames = ["mass","abundance","c","h","o","n","s","na","k,","homo","homoval"]
-    dict100 = pd.read_csv(dictionarypath+ionisationmode[:3]+"\\dict100.csv")#,header=None,names=dictnames)
-    dict200 = pd.read_csv(dictionarypath+ionisationmode[:3]+"\\dict200.csv")#header=None,names=dictnames)
-    dict300 = pd.read_csv(dictionarypath+ionisationmode[:3]+"\\dict300.csv")#,header=None,names=dictnames)
-    dict400 = pd.read_csv(dictionarypath+ionisationmode[:3]+"\\dict400.csv")#,header=None,names=dictnames)
-    dict500 = pd.read_csv(dictionarypath+ionisationmode[:3]+"\\dict500.csv")#,header=None,names=dictnames)
-    dict600 = pd.read_csv(dictionarypath+ionisationmode[:3]+"\\dict600.csv")#,header=None,names=dictnames)
-    dict700 = pd.read_csv(dictionarypath+ionisationmode[:3]+"\\dict700.csv")#,header=None,names=dictnames)
+#A window is only loaded the first time a peak needs it, so a narrow peaklist never touches the rest, and only the last few used are kept.
+#Reading in the csv files can take 5-10 seconds, so each one is converted to a binary dictionary (.npy) the first time it is read,
+#and after that it is memory-mapped instead (near instant).
+#Makes sure every peak mass is inside a dictionary window. Any missing windows (FTPM.uncoveredwindows) are taken from the formula cache if they are
+#there, or else generated in this process with the same engine and elementallimits as 0-FormulaGenerator (FTPM.generatewindow) and saved into it.
+#They are then added to the mass index.
+def coverwindows(masses):
+    missing = FTPM.uncoveredwindows(dictionaryindex(ionisationmode),masses,generatedwidth)
+    for low, high in missing:
+        FTPM.startstage(metrics,"dictionary generation")
+        limits = FTPM.elementallimits(low,high,ionisationmode)
+        filename = FTPM.cacheddictionary(cachepath,ionisationmode,low,high,limits,FTPM.chemdict)
+        if filename is None:
+            print("Generating " + ionisationmode + " mode formulae between " + str(low) + " and " + str(high) + " m/z")
+            filename = FTPM.generatewindow(ionisationmode,low,high,FTPM.chemdict,cachepath)
+        generatedwindows[ionisationmode].append((filename,low,high))
+        FTPM.endstage(metrics,rowsout=len(FTPM.loaddictionary(filename)))
+    if len(missing) > 0:
+        dictionaryindex.cache_clear()
+    return dictionaryindex(ionisationmode)
+
+#In a worker process for parallel assignment, the windows are read straight from the shared memory the main process put them in.
+@lru_cache(maxsize=dictionarycachesize)
+def loadwindow(filename):
+    if filename in sharedwindows:
+        return sharedwindows[filename][1]
+    FTPM.startstage(metrics,"dictionary load")
+    x = FTPM.loaddictionary(filename)
+    FTPM.endstage(metrics,rowsout=len(x))
+    return x
+
+sharedindex = None # the mass index, and the shared memory blocks and arrays of its windows (by filename), in a worker process for parallel assignment.
+#The service (see serve) also keeps its windows here, in memory, with no block.
+sharedwindows = {}
 
 # Timing function.
 def timeprint(timetext):
@@ -146,28 +253,13 @@ def timeprint(timetext):
 
 
 # This strips out KMDs with < minKMDseries entries.
-# Test function tests if the value (KMD) is in our list of approved values (okvals) ## rename this function and variables in a future version? - wk
-def testfunc(i,okvals):
-    if i not in okvals:
-        a = 1
-    else:
-        a = 0
-    return a
-
 #This does the stripping. Returns our dataframe minus rows with KMDs we don't want to use.
 def StripMinClass(x, maxgap): # this removes from each Z* values, based on their KMD, which don't belong to a large enough group (as defined by maxgap)
     x.sort_values(by="KMD",inplace=True)
-    KMDint = x["KMD"].values.tolist()
-    KMDint = [int((i*(1/maxgap))) for i in KMDint]
-    KMDict = Counter(KMDint)
-    #this checks the frequency of occurency for KMD values. We can make a list of KMD values which occur more then our "minKMDseries" and delete the rest.
-    for key, count in dropwhile(lambda key_count: key_count[1] >= minKMDseries, KMDict.most_common()):
-        del KMDict[key]
-    x["KMDint"] = KMDint
-    okvals = list(KMDict.keys())
-    x["test"] = x.apply(lambda row: testfunc(row["KMDint"],okvals),axis=1)
-    x = x[x["test"] == 0]
-    x = x.drop("test",axis=1)
+    x["KMDint"] = (x["KMD"].values*(1/maxgap)).astype(int)
+    #this counts the members of each KMD series (a grouped count), and keeps the peaks in series with at least our "minKMDseries" members.
+    seriessize = x.groupby("KMDint")["KMDint"].transform("size")
+    x = x[(seriessize >= minKMDseries).values]
     return x
 
 
@@ -191,73 +283,36 @@ def homochecker(o,n,s,na):
 #If the errors are acceptable, the formulae is decided to be a hit, and the entry added to the assigned peak list.
 #There is no redundnacy for assigning the same peak to multiple formulae in this version.
 # This is not forseen to be a problem in high res, CHO spectra. IT may be an issue when more heteroatoms are considered and/or broader error ranges used.
-def form_checker(low,high,mass,threshppm,intensity):
-	allposs = []
-	i=0
-	if 100.0 <= mass <= 700.0:
-		if 100 <= mass < 200:
-			dicta = dict100
-		elif 200.0 <= mass < 300.0:
-			dicta = dict200
-		elif 300.0 <= mass < 400.0:
-			dicta = dict300
-		elif 400.0 <= mass < 500.0:
-			dicta = dict400
-		elif 500.0 <= mass < 600.0:
-			dicta = dict500
-		elif 600.0 <= mass < 700.0:
-			dicta = dict600
-		elif 700.0 <= mass < 800.0:
-			dicta = dict700
-		for x in dicta.itertuples():
-			if low <= x[1] <=high:
-				error = ((mass - x[1])/x[1])*1000000
-				if abs(error) <= threshppm:
-					allposs.append(list(x[1:9]))
-					allposs[i].append(error)
-					allposs[i].append(intensity)
-					allposs[i].append(mass)
-					formulatemp = FTPM.formulator(int(x[3]),int(x[4]),int(x[6]),int(x[5]),int(x[7]),int(x[8]),int(x[9]),int(x[10]),ionisationmode)
-					dbe = FTPM.DBEcalc(int(x[3]),int(x[4]),int(x[6]),ionisationmode)
-					allposs[i].append(dbe)
-					allposs[i].append(formulatemp)
-					i = i +1
-	return allposs
-
-# Calculates the kendrick mass, nominal kendrick mass, kendrick mass defect, and Z star.
-def calcprop(xmass,kendrickseries): #Should now work with any kendrick mass series - CH2, OH2, etc.
-	kmass = xmass * (kendrickseries[0]/kendrickseries[1])
-	if kmass % 2 == 0:
-		nmass = int(kmass)
-	else:
-		nmass = int(kmass)+1
-	kmd = nmass - kmass
-	zstar = ((nmass % int(kendrickseries[0])) - int(kendrickseries[0]))*-1
-	return kmass,nmass,kmd,zstar
-
-#This calculates the kendrick mass properties for a given peak. It calls the earlier kendrick mass function.
+#If stats is given, the number of formulae scanned is added to stats["scanned"].
+#Returns the matching formula records (see FTPM.formuladtype) and their errors.
+def form_checker(low,high,mass,threshppm,stats=None):
+	keep = []
+	errors = []
+	inrange = FTPM.indexrange(dictionaryindex(ionisationmode),low,high,loadwindow)
+	if stats is not None:
+		stats["scanned"] = stats.get("scanned",0) + len(inrange)
+	for i, x in enumerate(inrange["mass"].tolist()): #the dictionaries are typed arrays sorted by mass
+		error = ((mass - x)/x)*1000000
+		if abs(error) <= threshppm:
+			keep.append(i)
+			errors.append(error)
+	return np.asarray(inrange[keep]), np.array(errors,dtype="f8")
+
+#This calculates the kendrick mass properties for the peaks, as array operations over all of them at once (see FTPM.kendrickproperties).
 def kmdpart(output,peaksfloat,kendrickseries):
 	#This bit calculates the kendrick mass, Nominal mass, kmd, and z* for each input peak
-	KMD = [] #Kendrick mass defect
-	NKM = [] #Nominal kendrick mass
-	KM = [] #Kendrick Mass
-	Zstar = [] #Z*
-	i=0
-	for p in peaksfloat: #We have to work with our peaks as floats here
-		kmass,nmass,kmd,zstar = calcprop(p,kendrickseries)
-		KMD.append(kmd)
-		NKM.append(nmass)
-		KM.append(kmass)
-		Zstar.append(zstar)
-		i = i + 1
+	FTPM.startstage(metrics,"kendrick " + str(kendrickseries[1]))
+	KM, NKM, KMD, Zstar = FTPM.kendrickproperties(peaksfloat,kendrickseries)
 	output["KM"]=KM
 	output["NKM"]=NKM
 	output["KMD"]=KMD
 	output["Z*"]=Zstar
+	FTPM.endstage(metrics,rowsin=len(output),rowsout=len(output))
 
 	timeprint(" Time to calculate the kendrick properties for " +str(kendrickseries[0]) +" = "+ str(kendrickseries[1]))
 
 	#This bit splits the output into the z*s. The zs are a list of lists. This allows n-z* groups, and thus any kendrick mass unit should work.
+	FTPM.startstage(metrics,"zstar strip")
 	output.sort_values(by="Z*",inplace=True)
 	z = output.groupby('Z*')
 	zs = []
@@ -265,139 +320,187 @@ def kmdpart(output,peaksfloat,kendrickseries):
 		y = z.get_group((x))
 		y = StripMinClass(y.copy(),maxgap)
 		zs.append(y)
+	FTPM.endstage(metrics,rowsin=len(output),rowsout=sum(len(y) for y in zs))
 	return zs #list of lists
 
-#This section calls together a few functions as we process a given list of z-stars. It is called for each kendrick mass unit we are using.
-def assigningpart(zs):
-    assigned = []
-    for z in zs:
-        for y in z.itertuples():
-            formulae=[]
-            mass = y[1]
-            intensity = y[2]
+#Batched version of form_checker for a whole array of peaks. Peaks are matched against the dictionaries in one interval join per window (FTPM.indexjoin).
+#Returns the peak (position in masses), formula record and error of every match - the same matches as form_checker peak by peak, in the same order.
+def batchform_checker(masses,stats=None):
+    return FTPM.indexjoin(dictionaryindex(ionisationmode),masses,threshold,threshppm,loadwindow,stats)
+
+#Looks up the candidate formulae for the peaks (by their position in the peak table) not yet looked up, and adds them to candidates (see FTPM.newcandidates).
+#Each peak is only looked up once, however many passes it goes through. Candidates are only element counts - their formulae are written in
+#formulacolumns, once the hits are known.
+def updatecandidates(candidates,peaks,positions):
+    new = positions[~candidates["looked"][positions]]
+    if len(new) == 0:
+        return candidates
+    FTPM.startstage(metrics,"candidate lookup")
+    stats = {"scanned":0}
+    masses = peaks.iloc[new,0].values.astype(float)
+    if batchassign: #all the new peaks in one join
+        peak, records, errors = batchform_checker(masses,stats)
+    else:
+        found = []
+        for mass in masses:
             low = mass - threshold #error threshold (absolute)
             high = mass + threshold
-            allposs = form_checker(low,high,mass,threshppm,intensity)
-            formulae.append(allposs) #Allposs is a list comprising the elements from the dictionary for matching formula - i.e. exact mass, kmd, C, H, O, N, S, Na, homo, homosum.
-            assigned.append(formulae)
-    new = [item for it in assigned for item in it] #variables may need to be cleaned up - wk
-    assigned = [item for it in new for item in it] #variables may need to be cleaned up - wk
-    #this set of outheaders is designed to fit the other scripts which were written prior to this. As such, certain columns may seem redunandt
-    outheaders = ["Theor. Mass","Isotopic Abundance","C","H","O","N","S","Na","Error","Rel. Abundance","Exp. m/z","DBE","Formula"]
-    assignedDF = pd.DataFrame(assigned,columns=outheaders)
-    newcols = ["Exp. m/z","Theor. Mass","Error","Rel. Abundance","DBE","C","H","N","O","S","Formula"]#,"Nano","Isotopic Abundance"]
-    if ionisationmode =="negative":
-        assignedDF["Hno"] = assignedDF["H"].add(1)
-    assignedDF = assignedDF[newcols]
+            found.append(form_checker(low,high,mass,threshppm,stats)) #the formulae from the dictionary matching the peak, and their errors
+        peak = np.repeat(np.arange(len(masses)),[len(x[1]) for x in found])
+        records = np.concatenate([x[0] for x in found]) if len(found) > 0 else np.zeros(0,dtype=FTPM.formuladtype)
+        errors = np.concatenate([x[1] for x in found]) if len(found) > 0 else np.zeros(0)
+    FTPM.addcandidates(candidates,new,new[peak],records,errors)
+    FTPM.endstage(metrics,rowsin=len(new),rowsout=len(peak),candidates=stats["scanned"])
+    return candidates
+
+#With candidatecache, the raw candidates of all the peaks (every pair within candidatethreshold and candidatethreshppm) are found in one join and
+#kept in the candidate cache. If the same peaks have been assigned against the same dictionaries before, they are read back instead and only
+#narrowed down to threshold and threshppm - so a change of threshold, threshppm, maxgap or minKMDseries never searches the dictionaries again.
+def cachedcandidates(candidates,peaks):
+    index = dictionaryindex(ionisationmode)
+    masses = peaks.iloc[:,0].values.astype(float)
+    widethreshold, widethreshppm = max(threshold,candidatethreshold), max(threshppm,candidatethreshppm)
+    FTPM.startstage(metrics,"candidate lookup")
+    stats = {"scanned":0} #stays 0 when the candidates are read back from the cache, as no dictionary is searched
+    filename = FTPM.candidatecachepath(candidatecachepath,ionisationmode,masses,index,widethreshold,widethreshppm)
+    raw = FTPM.loadcandidates(filename)
+    if raw is None:
+        raw = FTPM.candidatejoin(index,masses,widethreshold,widethreshppm,loadwindow,stats)
+        FTPM.savecandidates(raw,filename)
+    x = FTPM.filtercandidates(raw,masses,threshold,threshppm)
+    FTPM.addcandidates(candidates,np.arange(len(masses)),x["peak"],x["formula"],x["error"])
+    FTPM.endstage(metrics,rowsin=len(masses),rowsout=len(x),candidates=stats["scanned"])
+    return candidates
+
+#This section calls together a few functions as we process a given list of z-stars. It is called for each kendrick mass unit we are using.
+#The candidates of each peak come from the cross-pass cache (updatecandidates), and are picked out for the peaks of the z-stars, in order, as array rows.
+#The hits carry the masses and abundances of their isotopologues from the dictionaries (isotopecolumns) to the isotope check.
+def assigningpart(zs,candidates,peaks):
+    rows = FTPM.peakcandidates(candidates,peaks.index.get_indexer([x for z in zs for x in z.index]))
+    peak = candidates["peak"][rows]
+    x = candidates["formula"][rows]
+    #these columns are designed to fit the other scripts which were written prior to this.
+    assignedDF = pd.DataFrame({"Exp. m/z":peaks.iloc[:,0].values.astype(float)[peak],"Theor. Mass":x["mass"],"Error":candidates["error"][rows],
+                               "Rel. Abundance":peaks.iloc[:,1].values[peak],"C":x["C"],"H":x["H"],"N":x["N"],"O":x["O"],"S":x["S"],"P":x["P"]})
+    for name in isotopecolumns():
+        assignedDF[name] = x[name]
     assignedDF.sort_values(by="Exp. m/z",inplace=True)
-    formulae = assignedDF["Formula"]
-    heteroclasses = []
-    for x in formulae:
-        split = re.split('([H][\d]+)',x)
-        heteroclasses.append(split[-1])
-    assignedDF["HeteroClass"] = heteroclasses
     return assignedDF
 
+#The isotopologues looked for (see isotopesearched), as (name, element, number of heavy atoms), in the order of FTPM.isotopologues.
+def searchedisotopes():
+    return [(name, FTPM.isotopedict[isotope][0], count) for name, isotope, count in FTPM.isotopologues if name in isotopesearched]
+
+#The dictionary columns the hits carry for the isotope check - the mass and abundance of each isotopologue looked for.
+def isotopecolumns():
+    return [x+name for name, element, count in searchedisotopes() for x in ["mass","abundance"]]
+
+#Adds the DBE, Formula and HeteroClass of the hits, for all of them at once, after the last pass. Until here the hits are only element counts.
+def formulacolumns(assignedDF):
+    c, h, n, o, s, p = [assignedDF[x].values.astype(int) for x in ["C","H","N","O","S","P"]]
+    assignedDF.insert(4,"DBE",FTPM.DBEvalues(c,h,n,ionisationmode))
+    assignedDF["Formula"] = FTPM.formulastrings(c,h,n,o,s,p,ionisationmode)
+    assignedDF["HeteroClass"] = FTPM.heteroclassstrings(n,o,s,p)
+    return assignedDF.drop("P",axis=1)
+
 
 def isotopechecker(unassignedDF,assignedDF):
-    #this section with isotopes could be significant expanded and refined.
-    c13 =1.003355 #exact mass difference of replacing a 12C atom with a 13C atom.
-    c13 = int(c13*precisionfactor) #How precise are we
-    isotopeheaders = ["Exp. m/z","Recal m/z","Theor. Mass","Error","Rel. Abundance","Signal2Noise","DBE","C","H","N","O","S","13C","18O","Formula","HeteroClass"]
-    a= 0
-    newlist = []
-    for x in unassignedDF.itertuples():
-        Xmass = int(x[1]*precisionfactor)
-        for y in assignedDF.itertuples():
-            Ymass = int(y[1]*precisionfactor)
-            if Xmass-Ymass == c13:
-                formula = FTPM.isotopeformulator(y[6]-1,y[7],y[8],y[9],y[10],0,0,ionisationmode,1,0)
-                newlist.append([x[1],x[1],x[1],0,x[2],0,y[5],y[6]-1,y[7],y[8],y[9],y[10],1,0,formula,y[12]])
-                a= a+1
-    #isotopologues = pd.DataFrame(data=newlist,columns=isotopeheaders)
-    #print("There were " + str(a) + " isotopologues identified")
-
-    c13 =1.003355 #exact mass difference of replacing a 12C atom with a 13C atom.
-    c13 = int(2*c13*precisionfactor) #How precise are we
-    #isotopeheaders = ["Exp. m/z","Recal m/z","Theor. Mass","Error","Rel. Abundance","Signal2Noise","DBE","Cno","Hno","Nno","Ono","Sno","13Cno","Formula","HeteroClass"]
-    #a= 0
-    #newlist = []
-    for x in unassignedDF.itertuples():
-        Xmass = int(x[1]*precisionfactor)
-        for y in assignedDF.itertuples():
-            Ymass = int(y[1]*precisionfactor)
-            if Xmass-Ymass == c13:
-                formula = FTPM.isotopeformulator(y[6]-1,y[7],y[8],y[9],y[10],0,0,ionisationmode,2,0)
-                newlist.append([x[1],x[1],x[1],0,x[2],0,y[5],y[6]-1,y[7],y[8],y[9],y[10],2,0,formula,y[12]])
-                a= a+1
-    #isotopologues = pd.DataFrame(data=newlist,columns=isotopeheaders)
-    #print("There were " + str(a) + " isotopologues identified")
-
-    #this section with isotopes could be significant expanded and refined.
-    o18 =2.004244 #exact mass difference of replacing a 16O atom with a 18O atom.
-    o18 = int(o18*precisionfactor) #How precise are we
-    #isotopeheaders = ["Exp. m/z","Recal m/z","Theor. Mass","Error","Rel. Abundance","Signal2Noise","DBE","Cno","Hno","Nno","Ono","Sno","13Cno","Formula","HeteroClass"]
-    #a= 0
-    #newlist = []
-    for x in unassignedDF.itertuples():
-        Xmass = int(x[1]*precisionfactor)
-        for y in assignedDF.itertuples():
-            Ymass = int(y[1]*precisionfactor)
-            if Xmass-Ymass == o18:
-                formula = FTPM.isotopeformulator(y[6]-1,y[7],y[8],y[9],y[10],0,0,ionisationmode,0,1)
-                newlist.append([x[1],x[1],x[1],0,x[2],0,y[5],y[6]-1,y[7],y[8],y[9],y[10],0,1,formula,y[12]])
-                a= a+1
-    isotopologues = pd.DataFrame(data=newlist,columns=isotopeheaders)
-    print("There were " + str(a) + " isotopologues identified")
+    #Each unassigned peak is checked against every assigned hit, for every isotopologue in isotopesearched, in one sorted search (FTPM.isotopejoin)
+    #against the isotopologue masses the dictionaries hold for the hits. A hit without enough of the element has no mass for that isotopologue.
+    FTPM.startstage(metrics,"isotope check")
+    isotopeheaders = ["Exp. m/z","Recal m/z","Theor. Mass","Error","Rel. Abundance","Signal2Noise","DBE","C","H","N","O","S","13C","18O","34S","15N","Formula","HeteroClass"]
+    isotopes = searchedisotopes()
+    peaks = unassignedDF.iloc[:,0].values.astype(float)
+    intensities = unassignedDF.iloc[:,1].values
+    masses = np.array([assignedDF["mass"+name].values for name, element, count in isotopes],dtype="f8").reshape(len(isotopes),len(assignedDF))
+    matches = FTPM.isotopejoin(peaks,masses,isothreshold,isothreshppm)
+    if isoabundancetolerance is not None: #the isotopologue's intensity must be near that expected from its hit
+        abundances = np.array([assignedDF["abundance"+name].values for name, element, count in isotopes],dtype="f8").reshape(len(isotopes),len(assignedDF))
+        ratio = intensities[matches["peak"]] / (assignedDF["Abundance"].values[matches["hit"]] * abundances[matches["isotope"],matches["hit"]])
+        matches = matches[(ratio >= 1/isoabundancetolerance) & (ratio <= isoabundancetolerance)]
+    #The isotopologues are built as whole columns - one row per match.
+    elements = np.array([x[1] for x in isotopes] + [""])[matches["isotope"]]
+    counts = np.array([x[2] for x in isotopes] + [0],dtype="i8")[matches["isotope"]]
+    peak, hit = matches["peak"], matches["hit"]
+    light, heavy = {}, {}
+    for element in ["C","N","O","S"]:
+        heavy[FTPM.isotopelabel[element]] = np.where(elements == element,counts,0)
+        light[element] = assignedDF[element].values.astype(int)[hit] - heavy[FTPM.isotopelabel[element]]
+    h = assignedDF["H"].values.astype(int)[hit]
+    isotopologues = pd.DataFrame({"Exp. m/z":peaks[peak],"Recal m/z":peaks[peak],"Theor. Mass":masses[matches["isotope"],hit],
+                                  "Error":matches["error"],"Rel. Abundance":intensities[peak],"Signal2Noise":0,"DBE":assignedDF["DBE"].values[hit],
+                                  "C":light["C"],"H":h,"N":light["N"],"O":light["O"],"S":light["S"],"13C":heavy["13C"],"18O":heavy["18O"],"34S":heavy["34S"],"15N":heavy["15N"],
+                                  "Formula":FTPM.isotopologuestrings(light["C"],h,light["N"],light["O"],light["S"],heavy),"HeteroClass":assignedDF["HeteroClass"].values[hit]},
+                                 columns=isotopeheaders)
+    FTPM.endstage(metrics,rowsin=len(unassignedDF),rowsout=len(isotopologues),candidates=len(matches))
+    print("There were " + str(len(isotopologues)) + " isotopologues identified")
 
     return isotopologues
 
 #This main body of code performs the script for us. It will read in the data, and assign peaks.
 def mainbody(filename):
+    return assignpeaks(readpeaklist(filename))
+
+#Reads a tab separated peaklist (m/z, then intensity, then anything else), dropping any empty columns.
+def readpeaklist(filename):
+    FTPM.startstage(metrics,"peaklist load")
     data = pd.read_csv(filename,delimiter='\t')
     data.dropna(inplace=True,axis=1)
+    FTPM.endstage(metrics,rowsout=len(data))
+    return data
 
+#This assigns a table of peaks. previoushits are hits already assigned to lower m/z peaks (the chunk before, when streaming),
+#which the peaks are also checked for being isotopologues of.
+#If carried is given, carried["hits"] is set to the hits with the isotopologue columns still on (see isotopecolumns), to be handed on as previoushits.
+def assignpeaks(data,previoushits=None,carried=None):
     #headers = ["m/z","I","Res.","KM","NKM","KMD","Z*"] #keeps track of what your columns mean
     #npeaks = len(data) #calculates number of peaks
     #nheaders = len(headers)
 
-    output = pd.DataFrame(data[data["m/z"]<highlmt])
-    peaksfloat = output["m/z"].tolist()
+    peaks = pd.DataFrame(data[data["m/z"]<highlmt]) #the peak state table
+    peaks["Pass"] = -1 #the pass which assigned each peak, -1 while unassigned
+    candidates = FTPM.newcandidates(len(peaks)) #the candidate formulae of each peak, by position in peaks. Looked up once and reused by every pass.
+    if generatemissing:
+        coverwindows(peaks["m/z"].values)
+    if candidatecache:
+        cachedcandidates(candidates,peaks)
 
     #output["m/zint"] = output["m/z"].apply(multiplyprecision)
     #peaks = output["m/zint"].tolist()
 
     timeprint(" Time to read in and sort the data")
 
-    zs = kmdpart(output,peaksfloat,CH2)
-    #zs = kmdpart(output,peaksfloat,CO2) #this build based on CO2 series - doesn't seem to get any hits?
-    #zs = kmdpart(output,peaksfloat,H2) #this build based on H2 series - Lots of hits/too many?
-
     #This ends the reading and sorting of data
-    assignedDF = assigningpart(zs)
+    #Each pass groups the still unassigned peaks into series with its own Kendrick base - only the grouping changes between passes.
+    assignedDF = None
+    for passno, kendrickseries in enumerate(kendrickpasses):
+        output = pd.DataFrame(peaks[peaks["Pass"] < 0][data.columns])
+        peaksfloat = output["m/z"].tolist()
+        zs = kmdpart(output,peaksfloat,kendrickseries)
+        positions = peaks.index.get_indexer([x for z in zs for x in z.index])
+        updatecandidates(candidates,peaks,positions)
+        passDF = assigningpart(zs,candidates,peaks)
+        hit = positions[candidates["offsets"][positions+1] > candidates["offsets"][positions]]
+        peaks.loc[peaks.index[hit],"Pass"] = passno
+        if assignedDF is None:
+            assignedDF = passDF
+        else:
+            assignedDF = pd.concat((assignedDF,passDF), ignore_index=True)
+    assignedDF = formulacolumns(assignedDF)
     unassignedDF = data[~data["m/z"].isin(assignedDF["Exp. m/z"])].dropna()
-
-    output = pd.DataFrame(unassignedDF[unassignedDF["m/z"]<highlmt])
-    peaksfloat = output["m/z"].tolist()
-    
-    
-    zs = kmdpart(output,peaksfloat,OH2)
-    assignedDF = pd.concat((assignedDF,assigningpart(zs)), ignore_index=True)
-
-    unassignedDF = data[~data["m/z"].isin(assignedDF["Exp. m/z"])].dropna()
-    output = pd.DataFrame(unassignedDF[unassignedDF["m/z"]<highlmt])
-    peaksfloat = output["m/z"].tolist()
-    
-    
-    zs = kmdpart(output,peaksfloat,H2)
-    assignedDF = pd.concat((assignedDF,assigningpart(zs)), ignore_index=True)
     assignedDF = assignedDF.rename(columns={"Rel. Abundance":"Abundance"})
     assignedhitcount = str(len(assignedDF))
     print("There were " +assignedhitcount +" monoisotopic formulae assigned")
 
-    isotopologues = isotopechecker(unassignedDF,assignedDF)
+    if previoushits is None:
+        isotopologues = isotopechecker(unassignedDF,assignedDF)
+    else:
+        isotopologues = isotopechecker(unassignedDF,pd.concat((previoushits,assignedDF),ignore_index=True))
     isotopologues = isotopologues.drop("Recal m/z",axis=1)
     isotopologues = isotopologues.rename(columns={"Rel. Abundance":"Abundance"})
+    if carried is not None:
+        carried["hits"] = assignedDF
+    assignedDF = assignedDF.drop(columns=isotopecolumns())
 
     unassignedDF = data[~data["m/z"].isin(assignedDF["Exp. m/z"])].dropna()
     unassignedDF = unassignedDF[~unassignedDF["m/z"].isin(isotopologues["Exp. m/z"])].dropna()
@@ -406,18 +509,190 @@ def mainbody(filename):
     timeprint(" Time to complete")
     return assignedDF, isotopologues, unassignedDF
 
+#Streaming version of mainbody, for very large peaklists. The peaklist (which must be in m/z order) is read streamchunk peaks at a time, and each chunk
+#is assigned and handed on before the next is read, so memory use does not grow with the size of the peaklist.
+#The hits at the top of each chunk are carried into the next, so isotopologues are still found across the chunk edges.
+#NB: with minKMDseries above 1, series are only grouped within a chunk, so keep streamchunk large.
+def streambody(filename):
+    shifts = FTPM.isotopeshifts([x for x in FTPM.isotopologues if x[0] in isotopesearched])
+    reach = max([x[0] for x in shifts.values()] + [0]) + isothreshold #the furthest above a hit its isotopologues can be
+    columns, previoushits, lastmz, carried = None, None, -np.inf, {}
+    reader = pd.read_csv(filename,delimiter='\t',chunksize=streamchunk)
+    while True:
+        FTPM.startstage(metrics,"peaklist load")
+        data = next(reader,None)
+        FTPM.endstage(metrics,rowsout=0 if data is None else len(data))
+        if data is None:
+            break
+        if columns is None: #as mainbody, empty columns are dropped - judged by the first chunk
+            columns = data.dropna(axis=1).columns
+        data = data[columns]
+        if data["m/z"].iloc[0] < lastmz or not data["m/z"].is_monotonic_increasing:
+            raise ValueError(filename + " is not in m/z order, so it cannot be streamed - sort it or set streampeaklists = False")
+        lastmz = data["m/z"].iloc[-1]
+        assignedDF, isotopologues, unassignedDF = assignpeaks(data,previoushits,carried)
+        previoushits = carried["hits"][carried["hits"]["Theor. Mass"] >= lastmz - reach]
+        yield assignedDF, isotopologues, unassignedDF
+
 def godo(fileloc,filen):
-    assignedDF,isotopologues, unassignedDF = mainbody(fileloc)
+    global metrics
+    metrics = FTPM.newstagemetrics(filen) if stagemetrics else None
     FTPM.make_sure_path_exists(path +"/OutputCSV/") #this function checks the output directory exists; if it doesnt, it creates it.
-    assignedDF.to_csv(path+"/OutputCSV/"+filen[:-4]+"-hits.csv")
-    isotopologues.to_csv(path+"/OutputCSV/"+filen[:-4]+"-isohits.csv")
-    unassignedDF.to_csv(path+"/OutputCSV/"+filen[:-4]+"-nohits.csv")
-
-
-filesA = os.listdir(path+"InputPeaklist/")
-for i in filesA:
-    if i[-4:] == ".txt":
-        fileloc = path +"InputPeaklist/" + i
-        godo(fileloc,i)
-
-print("EOF")
+    if streampeaklists: #each chunk is appended to the outputs as soon as it is assigned
+        outputs = [path+"/OutputCSV/"+filen[:-4]+"-"+x+".csv" for x in ("hits","isohits","nohits")]
+        counts = [0,0,0]
+        for i, frames in enumerate(streambody(fileloc)):
+            FTPM.startstage(metrics,"csv write")
+            for j, frame in enumerate(frames):
+                if j < 2: #hits and isohits are numbered on through the whole peaklist. nohits keep their row in the peaklist.
+                    frame.index = range(counts[j],counts[j]+len(frame))
+                frame.to_csv(outputs[j],mode="w" if i == 0 else "a",header=(i == 0))
+                counts[j] = counts[j] + len(frame)
+            FTPM.endstage(metrics,rowsin=sum(len(x) for x in frames),rowsout=sum(len(x) for x in frames))
+    else:
+        assignedDF,isotopologues, unassignedDF = mainbody(fileloc)
+        rows = len(assignedDF) + len(isotopologues) + len(unassignedDF)
+        if outputformat != "parquet":
+            FTPM.startstage(metrics,"csv write")
+            assignedDF.to_csv(path+"/OutputCSV/"+filen[:-4]+"-hits.csv")
+            isotopologues.to_csv(path+"/OutputCSV/"+filen[:-4]+"-isohits.csv")
+            unassignedDF.to_csv(path+"/OutputCSV/"+filen[:-4]+"-nohits.csv")
+            FTPM.endstage(metrics,rowsin=rows,rowsout=rows)
+        if outputformat != "csv":
+            FTPM.startstage(metrics,"parquet write")
+            FTPM.writeresults(path+"/OutputCSV/"+filen[:-4]+"-results.parquet",assignedDF,isotopologues,unassignedDF)
+            FTPM.endstage(metrics,rowsin=rows,rowsout=rows)
+    if metrics is not None:
+        with open(path+"/OutputCSV/"+filen[:-4]+"-metrics.json","w") as f:
+            json.dump(FTPM.finishmetrics(metrics),f,indent=1)
+    return metrics
+
+#Writes the summary of the stage metrics of a batch of peaklists, and prints it.
+def writesummary(runs):
+    runs = [x for x in runs if x is not None]
+    if len(runs) == 0:
+        return
+    summary = FTPM.summarisemetrics(runs)
+    with open(path+"/OutputCSV/batch-metrics.json","w") as f:
+        json.dump(summary,f,indent=1)
+    print("Stages of the " + str(len(runs)) + " peaklists assigned, in " + str(round(summary["seconds"],3)) + " s:")
+    print(FTPM.stagemetricsreport(summary))
+
+#Sets up a worker process for parallel assignment. The ionisation mode and the mass index come from the main process, and each window is
+#attached from shared memory without copying it.
+def batchinit(mode,index,specs):
+    global ionisationmode, sharedindex
+    ionisationmode = mode
+    sharedindex = index
+    for filename, spec in specs.items():
+        sharedwindows[filename] = FTPM.attacharray(spec)
+
+#Assigns a list of peaklists, given as (file location, file name), over a pool of nworkers processes.
+#The dictionary windows are loaded once, here, into shared memory, and every worker reads the same copy.
+#Peaklists are submitted largest first, so no worker is left with a big one at the end. Each worker writes a peaklist's results as soon as it is done.
+def batchgodo(files):
+    from concurrent.futures import ProcessPoolExecutor, as_completed
+    if generatemissing: #the windows are all made here first, so the workers share them
+        for fileloc, filen in files:
+            masses = pd.read_csv(fileloc,delimiter='\t',usecols=["m/z"])["m/z"].values
+            coverwindows(masses[masses < highlmt])
+    index = dictionaryindex(ionisationmode)
+    blocks, specs = FTPM.shareindex(index,loadwindow)
+    try:
+        files = sorted(files, key=lambda x: -os.path.getsize(x[0]))
+        with ProcessPoolExecutor(max_workers=nworkers or os.cpu_count() or 1,initializer=batchinit,initargs=(ionisationmode,index,specs)) as pool:
+            futures = {pool.submit(godo,fileloc,filen):filen for fileloc, filen in files}
+            runs = []
+            for future in as_completed(futures):
+                runs.append(future.result())
+                timeprint(" Assigned " + futures[future])
+    finally:
+        for block in blocks:
+            block.close()
+            block.unlink()
+    return runs
+
+#Holds every dictionary window for a mode in memory, for the service.
+def warmdictionaries(mode):
+    index = dictionaryindex(mode)
+    for filename in index["files"]:
+        if filename not in sharedwindows:
+            sharedwindows[filename] = (None, np.array(loadwindow(filename)))
+    return index
+
+#This runs the assignment as a long running local service, so the interpreter start, the imports and the dictionary load are only paid once.
+#POST a tab separated peaklist (as in InputPeaklist) to http://127.0.0.1:8000/assign - add ?mode=positive or ?mode=negative to override the mode given
+#at start up. The hits, isohits and nohits come back as a json object of csv text, the same as the files godo writes.
+#GET /status returns the mode and the windows held. Requests are handled one at a time.
+def serve(mode):
+    import io
+    from http.server import HTTPServer, BaseHTTPRequestHandler
+    from urllib.parse import urlparse, parse_qs
+    warmdictionaries(mode)
+    def reply(handler,status,body):
+        content = json.dumps(body).encode("utf-8")
+        handler.send_response(status)
+        handler.send_header("Content-Type","application/json")
+        handler.send_header("Content-Length",str(len(content)))
+        handler.end_headers()
+        handler.wfile.write(content)
+    class assignmenthandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if urlparse(self.path).path != "/status":
+                return reply(self,404,{"error":"unknown path " + self.path})
+            reply(self,200,{"mode":mode,"windows":len(sharedwindows)})
+        def do_POST(self):
+            global ionisationmode, startTime, metrics
+            url = urlparse(self.path)
+            if url.path != "/assign":
+                return reply(self,404,{"error":"unknown path " + self.path})
+            requestmode = parse_qs(url.query).get("mode",[mode])[0].lower()
+            if requestmode != "negative" and requestmode != "positive":
+                return reply(self,400,{"error":"mode must be negative or positive"})
+            ionisationmode = requestmode
+            startTime = datetime.now()
+            metrics = FTPM.newstagemetrics("service") if stagemetrics else None
+            try: #a peaklist we can't read is the client's error (400)
+                data = readpeaklist(io.StringIO(self.rfile.read(int(self.headers.get("Content-Length",0))).decode("utf-8")))
+                if len(data.columns) < 2 or data.columns[0] != "m/z" or not all(pd.api.types.is_numeric_dtype(data[x]) for x in data.columns[:2]):
+                    raise ValueError("the peaklist must be tab separated, with a numeric m/z column followed by the intensities")
+            except Exception as e:
+                status, body = 400, {"error":repr(e)}
+            else:
+                try: #anything failing while assigning it is ours (500) - the service carries on
+                    warmdictionaries(requestmode)
+                    assignedDF, isotopologues, unassignedDF = assignpeaks(data)
+                    status, body = 200, {"mode":requestmode,"hits":assignedDF.to_csv(),"isohits":isotopologues.to_csv(),"nohits":unassignedDF.to_csv(),
+                                         "time":str(datetime.now() - startTime)}
+                except Exception as e:
+                    status, body = 500, {"error":repr(e)}
+            if metrics is not None:
+                metrics = FTPM.finishmetrics(metrics)
+            if status == 200:
+                body["metrics"] = metrics
+            reply(self,status,body)
+    server = HTTPServer(serviceaddress,assignmenthandler)
+    print("Assignment service for " + mode + " mode listening on http://" + serviceaddress[0] + ":" + str(serviceaddress[1]))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+#Finally, this bit runs the assignment for every peaklist in the InputPeaklist folder.
+#It only runs when the script is run directly, so that the processes used for parallel assignment don't re-run it (or ask for the mode again).
+if __name__ == "__main__":
+    ionisationmode = askmode()
+    startTime = datetime.now()
+    if servicemode:
+        serve(ionisationmode)
+    else:
+        filesA = [(path +"InputPeaklist/" + i, i) for i in os.listdir(path+"InputPeaklist/") if i[-4:] == ".txt"]
+        if nworkers == 1 or len(filesA) < 2:
+            runs = [godo(fileloc,i) for fileloc, i in filesA]
+        else:
+            runs = batchgodo(filesA)
+        writesummary(runs)
+
+    print("EOF")
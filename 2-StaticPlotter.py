@@ -103,24 +103,20 @@ if hexbinlogic.upper() == "Y":
 else:
     hexbinlogic = False
 
-#This function lists all the files within our directory, and parses out only the "hits.csv" files.
+#This function lists all the files within our directory, and parses out only the "hits.csv" files (or "results.parquet" files).
 #It then reads in the data using the mycsvreader function.
 #Then it passes the data for each sample in turn to the plotter.
 def fileplotter():
     inputpath = path +"OutputCSV/"
     print("Looking for CSVs in " + inputpath)
-    filesA = os.listdir(inputpath)
-    filesB = []
-    for y in filesA:
-        if y[-8:] =="hits.csv" and y[-10:] != "nohits.csv" and y[-11:] !="isohits.csv":
-            filesB.append(y)
+    filesB = FTPM.resultfiles(inputpath)
     filenumbertotal = str(len(filesB))
     print("There are " + filenumbertotal +" CSVs to process")
     filenumber = 1
-    for y in filesB:
+    for sample, y in filesB:
         data,hetclassintdf = FTPM.mycsvreader(inputpath+y) # this reads the data using a csv reader function in the processing module.
         #this next bit passes the appropriate values to the plotting functions.
-        produceplots(y[:-9],data["RA"], data["DBE"], data["AI"],
+        produceplots(sample,data["RA"], data["DBE"], data["AI"],
                      data["OC"], data["HC"], data["NC"], data["SC"], 
                      data["mz"],data["Error"], data["C"], data["O"])
         print("Processed file " + str(filenumber) +" of "+ filenumbertotal +".")
@@ -68,20 +68,16 @@ inputpath = path +"OutputCSV/"
 outputpath = path + "Images/Classes/"
 FTPM.make_sure_path_exists(outputpath) #this function checks the output directory exists; if it doesnt, it creates it.
 print("Looking for CSVs in " + inputpath)
-filesA = os.listdir(inputpath)
-filesB = []
-for y in filesA:
-    if y[-8:] =="hits.csv" and y[-10:] != "nohits.csv" and y[-11:] !="isohits.csv":
-        filesB.append(y)        
+filesB = FTPM.resultfiles(inputpath) #the hits csvs, or results.parquet files, as (sample name, file)
 nfiles = len(filesB)
 
 samplenames=[]
-for x in filesB:
-    samplenames.append(x[:-9])
+for x, z in filesB:
+    samplenames.append(x)
     
 heteroclasses=[]
-for z in filesB:
-    df1 = pd.read_csv(inputpath+z,index_col=0)
+for x, z in filesB:
+    df1 = FTPM.readoutput(inputpath+z)
     hetclas = df1["HeteroClass"]
     hetclaslist = hetclas.tolist()
     heteroclasses.append(hetclaslist)
@@ -103,16 +99,16 @@ if whisky == True:
     
     outputdata = pd.DataFrame(index = range(len(indexlist)), columns=columnnames)
     a = 0
-    for y in filesB:
-        df2 = pd.read_csv(inputpath+y,index_col=0)
+    for sample, y in filesB:
+        df2 = FTPM.readoutput(inputpath+y)
         counter = Counter(df2["HeteroClass"])
         for x in counter:
-            outputdata.iloc[a][0] = y[:-9]
-            outputdata.iloc[a][1] = dict4[y[:-9]]["Class"]
-            outputdata.iloc[a][2] = dict4[y[:-9]]["Total Wood"]
-            outputdata.iloc[a][3] = dict4[y[:-9]]["Region"]
-            outputdata.iloc[a][4] = dict4[y[:-9]]["Age"]
-            outputdata.iloc[a][5] = dict4[y[:-9]]["Peated"]
+            outputdata.iloc[a][0] = sample
+            outputdata.iloc[a][1] = dict4[sample]["Class"]
+            outputdata.iloc[a][2] = dict4[sample]["Total Wood"]
+            outputdata.iloc[a][3] = dict4[sample]["Region"]
+            outputdata.iloc[a][4] = dict4[sample]["Age"]
+            outputdata.iloc[a][5] = dict4[sample]["Peated"]
             outputdata.iloc[a][6] = x  
             outputdata.iloc[a][7] = counter[x]
             a = a+1
@@ -122,12 +118,12 @@ else:
     columnnames = ["Sample","Class","HeteroClass","HeteroClassCount"]
     outputdata = pd.DataFrame(index = range(len(indexlist)), columns=columnnames)
     a = 0
-    for y in filesB:
-        df2 = pd.read_csv(inputpath+y,index_col=0)
+    for sample, y in filesB:
+        df2 = FTPM.readoutput(inputpath+y)
         counter = Counter(df2["HeteroClass"])
         for x in counter:
-            outputdata.iloc[a][0] = y[:-9]
-            outputdata.iloc[a][1] = y[:-9] #this is the Class variable, and should be defined as approrpriate for what you're plotting. In the case of single samples, it can be the sample name.
+            outputdata.iloc[a][0] = sample
+            outputdata.iloc[a][1] = sample #this is the Class variable, and should be defined as approrpriate for what you're plotting. In the case of single samples, it can be the sample name.
             outputdata.iloc[a][2] = x  
             outputdata.iloc[a][3] = counter[x]
             a = a+1
@@ -82,19 +82,15 @@ FTPM.make_sure_path_exists(outputpath)
 files = os.listdir(inputpath)
 
 def intfileplot():
-    filesA = os.listdir(inputpath)
-    filesB = []
-    for y in filesA:
-        if y[-8:] =="hits.csv" and y[-10:] != "nohits.csv" and y[-11:] !="isohits.csv":
-            filesB.append(y)
-    for y in filesB:
+    filesB = FTPM.resultfiles(inputpath) #the hits csvs, or results.parquet files
+    for sample, y in filesB:
         data,hetclassintdf = FTPM.mycsvreader(inputpath+y)
-        isodata = FTPM.isocsvreader(inputpath+y[:-8]+"isohits.csv")
-        nodata = FTPM.nohitsreader(inputpath+y[:-8]+"nohits.csv")
-        intplotter(data,isodata,nodata,y,hetclassintdf)
+        isodata = FTPM.isocsvreader(FTPM.resultfile(inputpath,sample,"isohit"))
+        nodata = FTPM.nohitsreader(FTPM.resultfile(inputpath,sample,"nohit"))
+        intplotter(data,isodata,nodata,sample,hetclassintdf)
         reset_output() #cleans up the cache which reduces file size
         
-def intplotter(data,isodata,nodata,y,hetclassintdf):
+def intplotter(data,isodata,nodata,sample,hetclassintdf):
     linewidth = 1.5
     source = ColumnDataSource(data)
     s2 = ColumnDataSource(data=dict(mz=data["mz"],Error=data["Error"],RA=data["RA"],
@@ -109,7 +105,7 @@ def intplotter(data,isodata,nodata,y,hetclassintdf):
     
     vkxlim = [0,1]
     vkylim = [0,2]
-    p1 = figure(tools=TOOLS, title=y[:-9]+" - Van Krevelen",width=figdims[0], height=figdims[1],
+    p1 = figure(tools=TOOLS, title=sample+" - Van Krevelen",width=figdims[0], height=figdims[1],
                 x_axis_label='O/C',y_axis_label='H/C',x_range=vkxlim,y_range=vkylim)
     color_mapper = LinearColorMapper(palette=glocmap, low=msxlim[0], high=msxlim[1])
     p1.scatter(x='OC', y='HC',source=source,size='VKsize', fill_color={'field': 'mz', 'transform': color_mapper},
@@ -128,7 +124,7 @@ def intplotter(data,isodata,nodata,y,hetclassintdf):
     dbeylim = [0,40]
     cmax = max(data["O"])
     cmax = int(5 * round(float(cmax)/5))
-    p2 = figure(tools=TOOLS, title=y[:-9]+" - DBE vs C# Plot",width=figdims[0],
+    p2 = figure(tools=TOOLS, title=sample+" - DBE vs C# Plot",width=figdims[0],
                 height=figdims[1], x_axis_label='C#',y_axis_label='DBE',x_range=dbexlim,y_range=dbeylim)
     color_mapper2 = LinearColorMapper(palette=glocmap2, low=0, high=cmax)
     p2.scatter(x='C', y='DBE',source=source,size='VKsize', fill_color={'field': 'O', 'transform': color_mapper2},
@@ -145,7 +141,7 @@ def intplotter(data,isodata,nodata,y,hetclassintdf):
     aixlim=[0,45]
     aiylim= [0,1]
 
-    p3 = figure(tools=TOOLS, title=y[:-9]+" - AI(mod) vs C# Plot",width=figdims[0],
+    p3 = figure(tools=TOOLS, title=sample+" - AI(mod) vs C# Plot",width=figdims[0],
                 height=figdims[1], x_axis_label='C#',y_axis_label='AI(mod)',x_range=aixlim,y_range=aiylim)
     color_mapper3 = LinearColorMapper(palette=glocmap2, low=0, high=cmax)    
     p3.scatter(x='C', y='AImod',source=source,size='VKsize', fill_color={'field': 'O', 'transform': color_mapper3},
@@ -159,7 +155,7 @@ def intplotter(data,isodata,nodata,y,hetclassintdf):
     p3.add_layout(color_bar3,"right")
 
     
-    p4 = figure(tools=TOOLS, title=y[:-9]+" - Assigned Centroid MS",width=figdims[0],
+    p4 = figure(tools=TOOLS, title=sample+" - Assigned Centroid MS",width=figdims[0],
                 height=figdims[1], x_axis_label='m/z',y_axis_label='Abundance',y_range=[min(data["RA"]),max(data["RA"])],
                 x_range=msxlim)
     p4.segment(x0=0,x1=800,y0=0,y1=0,line_width=1, line_color="black")
@@ -174,14 +170,14 @@ def intplotter(data,isodata,nodata,y,hetclassintdf):
     """
     #this is me trying to plot a barplot of heteroatomic class distributions...
     
-    p7 = figure(tools=TOOLS, title=y[:-9]+"",width=800, height=600, x_axis_label='HeteroClass',y_axis_label='Count',webgl=True)
+    p7 = figure(tools=TOOLS, title=sample+"",width=800, height=600, x_axis_label='HeteroClass',y_axis_label='Count',webgl=True)
     p7.quad(left="HetClassInts",y=hetclassdf[0],source=source,width=5,height=)
     
     t7 = layouts.Column(hist)
     tab7 = Panel(child=t7,title="test")
     """
     stretch = msxlim[0]*0.1
-    p5 = figure(tools=TOOLS, title=y[:-9]+" - Assigned Centroid MS",width=1400, height=600,
+    p5 = figure(tools=TOOLS, title=sample+" - Assigned Centroid MS",width=1400, height=600,
                 x_axis_label='m/z',y_axis_label='Abundance', y_range=[min(data["RA"]),max(data["RA"])],
                 x_range=(msxlim[0]-stretch,msxlim[1]+stretch))
     p5.segment(x0=0,x1=800,y0=0,y1=0,line_width=1, line_color="black")
@@ -319,7 +315,7 @@ def intplotter(data,isodata,nodata,y,hetclassintdf):
     
     #js_resources = JSResources(mode='inline')
     html = file_html(tabs,(CDN,CDN),"Interactive Van Krevelen Diagrams",template=template)
-    output_file2 = outputpath+y[:-9]+'-plot.html'
+    output_file2 = outputpath+sample+'-plot.html'
     with open(output_file2, 'w') as f:
         f.write(html)
     view(output_file2)
@@ -57,18 +57,18 @@ inputloc = path+"MergeInput/"
 outputloc = path+"MergeOutput/"
 FTPM.make_sure_path_exists(outputloc)
 
-files = os.listdir(inputloc)
+files = FTPM.resultfiles(inputloc) #the hits csvs, or results.parquet files, as (sample name, file)
 nfiles = len(files)
 
 samplenames=[]
-for x in files:
-    samplenames.append(x[:-9])
+for x, z in files:
+    samplenames.append(x)
     
 
 formulae=[]
 i = 1
-for z in files:
-    df1 = pd.read_csv(inputloc+z,index_col=0)
+for x, z in files:
+    df1 = FTPM.readoutput(inputloc+z)
     formula = df1["Formula"]
     formulalist = formula.tolist()
     formulae.append(formulalist)
@@ -86,8 +86,8 @@ indexes = ["mz"]+list(samplenames)
 outputdata = pd.DataFrame(index = indexes, columns=formulalist)
 
 dfrand = pd.DataFrame(index = samplenames, columns=formulalist, data=np.random.randint(200000,high=1500000,size=[len(samplenames),totaluniqueformula]))
-for y in files:
-    df2 = pd.read_csv(inputloc+y,index_col=0)    
+for sample, y in files:
+    df2 = FTPM.readoutput(inputloc+y)
     for i in range(len(df2)):
         mass = df2.loc[i]["Theor. Mass"]
         form = df2.loc[i]["Formula"]
@@ -95,7 +95,7 @@ for y in files:
             RA = df2.loc[i]["Rel. Abundance"]
         except:
             RA = df2.loc[i]["Abundance"]
-        outputdata.loc[y[:-9]][form] = RA
+        outputdata.loc[sample][form] = RA
         if pd.isnull(outputdata.iloc[0][form]):
             outputdata.iloc[0][form] = mass
 
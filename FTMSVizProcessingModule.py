@@ -26,16 +26,86 @@ This file is a holder for a number of key or long functions.
 Many of these are used multiple times in different scripts, and keeping them here allows for easier maintenance.
 
 """
-import os, errno, re, math
+import os, errno, re, math, hashlib, json, shutil, glob, time, tracemalloc
 import numpy as np
 import pandas as pd
 from collections import Counter
 
 
-#this function reads in a csv of the appropriate formatting
+#The assignment results (see 1-FormulaAssignment) can be written as three csvs per sample (XXX-hits.csv, XXX-isohits.csv and XXX-nohits.csv),
+#or as one typed columnar file (XXX-results.parquet) holding all three tables, told apart by a Status column.
+resultstatuses = ["hit","isohit","nohit"]
+
+#Writes the hits, isohits and nohits of a sample as one parquet file, with a Status column. Each table's own index is kept in a Row column.
+#Integer columns are kept as integers, even where another table does not have them. The columns of each table are kept in the file's metadata,
+#so a table reads back with its own columns even when it has no rows. Needs pyarrow.
+def writeresults(filename, assigned, isotopologues, unassigned):
+    import pyarrow as pa, pyarrow.parquet as pq
+    tables = []
+    owncolumns = {}
+    for status, x in zip(resultstatuses,(assigned,isotopologues,unassigned)):
+        x = x.infer_objects() #e.g. counts held as python ints
+        x = x.astype({c:"Int64" for c in x.columns if pd.api.types.is_integer_dtype(x[c])})
+        x.insert(0,"Status",status)
+        tables.append(x.rename_axis("Row").reset_index())
+        owncolumns[status] = list(tables[-1].columns)
+    columns = [] #the columns of all the tables, each table's in its own order, so a table reads back with its columns as they were
+    for x in tables:
+        at = 0
+        for c in x.columns:
+            if c in columns:
+                at = columns.index(c) + 1
+            else:
+                columns.insert(at,c)
+                at = at + 1
+    results = pd.concat(tables,ignore_index=True)[columns]
+    results["Status"] = pd.Categorical(results["Status"],categories=resultstatuses)
+    table = pa.Table.from_pandas(results,preserve_index=False)
+    metadata = dict(table.schema.metadata or {})
+    metadata[b"resultcolumns"] = json.dumps(owncolumns).encode()
+    pq.write_table(table.replace_schema_metadata(metadata),filename)
+
+#Reads one table (status is hit, isohit or nohit) back from a parquet file written by writeresults, as it would be read from its csv.
+#Columns only the other tables have are dropped (for files without the column lists, any column empty in this table).
+def readresults(filename, status):
+    import pyarrow.parquet as pq
+    table = pq.read_table(filename)
+    data = table.to_pandas()
+    data = data[data["Status"] == status]
+    metadata = table.schema.metadata or {}
+    if b"resultcolumns" in metadata:
+        data = data[json.loads(metadata[b"resultcolumns"])[status]].drop(columns="Status")
+    else:
+        data = data.drop(columns="Status").dropna(axis=1,how="all")
+    data = data.astype({c:"int64" for c in data.columns if isinstance(data[c].dtype,pd.Int64Dtype)})
+    data = data.set_index("Row")
+    data.index.name = None
+    return data
+
+#Reads an assignment output - a csv, or one table of a parquet results file.
+def readoutput(inputfile, status="hit"):
+    if inputfile[-8:] == ".parquet":
+        return readresults(inputfile,status)
+    return pd.read_csv(inputfile,index_col=0)
+
+#The hits of each sample in a folder of assignment outputs, as a list of (sample name, file). A sample's results.parquet is used over its csvs.
+def resultfiles(inputpath):
+    files = sorted(os.listdir(inputpath))
+    parquets = [(y[:-16],y) for y in files if y[-16:] == "-results.parquet"]
+    done = set(x[0] for x in parquets)
+    csvs = [(y[:-9],y) for y in files if y[-9:] == "-hits.csv" and y[-10:] != "nohits.csv" and y[-11:] != "isohits.csv" and y[:-9] not in done]
+    return sorted(parquets + csvs)
+
+#The file holding one table (status is hit, isohit or nohit) of a sample's results - its results.parquet if there is one, otherwise its csv.
+def resultfile(inputpath, sample, status):
+    if os.path.isfile(inputpath+sample+"-results.parquet"):
+        return inputpath+sample+"-results.parquet"
+    return inputpath+sample+"-"+status+"s.csv"
+
+#this function reads in a csv of the appropriate formatting (or the hits of a parquet results file)
 #calculates a few extra variables - i.e. H/C or O/C ratio.
 def mycsvreader(inputfile):
-    data = pd.read_csv(inputfile,index_col=0)
+    data = readoutput(inputfile,"hit")
     data=data.rename(columns = {'Cno':'C', 'Hno':'H','Sno':'S','Ono':'O',"Nno":"N","Pno":"P"}) #Rename some columns for ease of use/avoid issues
     data=data.rename(columns = {'Exp. m/z':'mz', 'Recal m/z':'Recalmz','Theor. Mass':'TheorMass','Abundance':'RA',"Rel. Abundance":"RA"}) #Rename some columns for ease of use/avoid issues
     calcheaders = ["AI","AImod","OC","HC","NC","SC","PC","VKsize"] #these are some values we need to calculate.
@@ -72,7 +142,7 @@ def mycsvreader(inputfile):
 
 # This function reads in an isotopologue hit list
 def isocsvreader(inputfile):
-    data = pd.read_csv(inputfile,index_col=0)
+    data = readoutput(inputfile,"isohit")
     data=data.rename(columns = {'Exp. m/z':'mz', 'Recal m/z':'Recalmz','Theor. Mass':'TheorMass','Abundance':'RA',"Rel. Abundance":"RA"}) #Rename some columns for ease of use/avoid issues
     calcheaders = ["AI","AImod","OC","HC","NC","SC","PC","VKsize"] #these are some values we need to calculate.
     vkfactor = (data["RA"].sum()/(5*data["RA"].mean()))/data["RA"].mean()
@@ -104,7 +174,7 @@ def isocsvreader(inputfile):
 
 #this function reads in an unassigned peak list
 def nohitsreader(inputfile):
-    data = pd.read_csv(inputfile,index_col=0)
+    data = readoutput(inputfile,"nohit")
     data=data.rename(columns = {'Exp. m/z':'mz', 'Recal m/z':'Recalmz','Theor. Mass':'TheorMass','Abundance':'RA'})
     return data
 
@@ -406,6 +476,75 @@ def isotopeformulator(c,h,n,o,s,na,k,ionisationmode,c13,o18):
             formula = formula +" K"+str(k)
     return formula
 
+#Kendrick mass, nominal Kendrick mass, Kendrick mass defect and Z* of an array of masses, for a Kendrick base given as (nominal mass, exact mass).
+#Given a list of bases, each array has one row per base, so all the bases are done at once.
+#The Kendrick mass is mass * nominal/exact. The nominal Kendrick mass rounds it up, unless it is an exact even number, the Kendrick mass defect is
+#nominal Kendrick mass - Kendrick mass, and Z* is -((nominal Kendrick mass % base nominal mass) - base nominal mass).
+def kendrickproperties(masses, kendrickseries):
+    masses = np.asarray(masses,dtype="f8")
+    bases = np.atleast_2d(np.asarray(kendrickseries,dtype="f8"))
+    ratio = np.array([[nominal/exact] for nominal, exact in bases.tolist()])
+    kmass = masses[np.newaxis,:] * ratio
+    nmass = kmass.astype(np.int64)
+    nmass = np.where(kmass % 2 == 0, nmass, nmass + 1)
+    kmd = nmass - kmass
+    nominal = bases[:,0:1].astype(np.int64)
+    zstar = ((nmass % nominal) - nominal)*-1
+    if np.ndim(kendrickseries[0]) == 0: #a single base
+        return kmass[0], nmass[0], kmd[0], zstar[0]
+    return kmass, nmass, kmd, zstar
+
+#The heavy isotope of each element an isotopologue can carry.
+isotopelabel = {"C":"13C","N":"15N","O":"18O","S":"34S"}
+
+#Vectorised versions of formulator and DBEcalc, for whole arrays of element counts at once (e.g. every hit of a peaklist). They give the same strings
+#and values as those do row by row, so formulae only have to be written out for the rows which are kept.
+def elementstrings(element, counts, always=False):
+    counts = np.asarray(counts,dtype="i8")
+    parts = np.char.add(element,counts.astype(str))
+    if always:
+        return parts
+    return np.where(counts > 0,parts,"")
+
+#The heteroclass part of the formula (everything after H), e.g. "O5S1".
+def heteroclassstrings(n,o,s,p):
+    classes = np.char.add(elementstrings("N",n),elementstrings("O",o))
+    return np.char.add(classes,np.char.add(elementstrings("S",s),elementstrings("P",p)))
+
+def formulastrings(c,h,n,o,s,p,ionisationmode):
+    h = np.asarray(h,dtype="i8")
+    if ionisationmode =="negative":
+        h = h+1
+    formulae = np.char.add(elementstrings("C",c,True),elementstrings("H",h,True))
+    return np.char.add(formulae,heteroclassstrings(n,o,s,p))
+
+def DBEvalues(C,H,N,ionisationmode):
+    C, H, N = np.asarray(C,dtype="i8"), np.asarray(H,dtype="i8"), np.asarray(N,dtype="i8")
+    if ionisationmode == "negative":
+        H = H+1
+    return (C+1-((H)/2)+(N/2))
+
+#Formula strings for isotopologues, e.g. "13C1 12C9 H10 O5", in the same style as isotopeformulator, for any of 13C, 15N, 18O and 34S.
+#c, h, n, o, s are the counts of the light isotopes left, and heavy gives the number of each heavy isotope per row, e.g. {"13C":array([1,0,...]),...}.
+#Isotopes not in heavy are taken as 0.
+def isotopologuestrings(c,h,n,o,s,heavy):
+    light = {"C":("13C","12C",c),"N":("15N","14N",n),"O":("18O","16O",o),"S":("34S","32S",s)}
+    formulae = None
+    for element, count in [("C",c),("H",h),("N",n),("O",o),("S",s)]:
+        count = np.asarray(count,dtype="i8")
+        if element in light:
+            label, lightlabel = light[element][0], light[element][1]
+            heavycount = np.asarray(heavy.get(label,np.zeros(len(count))),dtype="i8")
+            heavypart = np.char.add(elementstrings(label,heavycount,True),np.where(count > 0,np.char.add(" ",elementstrings(lightlabel,count,True)),""))
+            part = np.where(heavycount > 0,heavypart,elementstrings(element,count,element == "C"))
+        else:
+            part = elementstrings(element,count,True)
+        if formulae is None:
+            formulae = part
+        else:
+            formulae = np.char.add(formulae,np.where(part != "",np.char.add(" ",part),""))
+    return formulae
+
 #This function splits a string formula into its constituent parts of elemtnal numbers, and then returns the heteroclass
 def Form_To_Heteroclass(formula):
     het = []
@@ -425,3 +564,1112 @@ def Form_To_Heteroclass(formula):
         heterocl = heteroclass(c,h,n,o,s)
         het.append(heterocl)
     return het
+
+
+#####
+# Formula generation engine - used by 0-FormulaGenerator.py
+#####
+
+#atomic masses taken from Pure Appl. Chem. 2016; 88(3): 265–291, Atomic Weights of the Elements 2013, doi: 10.1515/pac-2015-0305
+#Atomic Masses taken from AME2012 - Chinese Physics C 36 (2012)  1603-2014, Wang, Audi, Wapstra, Kondex, MacCormic, Xu, and Pfeiffer. doi: 10.1088/1674-1137/36/12/003
+#isotoptic abundances from Pure Appl. Chem. 2016; 88(3): 293–306, Isotopic compositions of the elements 2013 (IUPAC Technical Report), doi: 10.1515/pac-2015-0503
+#electron mass from NIST http://physics.nist.gov/cgi-bin/cuu/Value?meu|search_for=electron+mass
+chemdict = {'H':(1.007825, 0.99984),
+            'C':(12.000000, 0.98892),
+            'N':(14.003074, 0.99634),
+            'O':(15.994915, 0.99762),
+            'Na':(22.989769, 1.0),
+            'P':(30.973763,1.0),
+            'S':(31.972071, 0.95041),
+            'Cl':(34.968853, 0.75765),
+            'K':(38.963706, 0.93258),
+            'Br':(78.918338, 0.50686),
+            'e':(0.0005485799, 1.0)} 
+
+#The heavier isotopes - the element they replace, their exact mass and natural abundance.
+#They are used for the isotopologue columns of the dictionaries (see isotopologues), which the isotopologue search of 1-FormulaAssignment matches against.
+isotopedict = {'13C':('C',13.003355, 0.01108),
+               '15N':('N',15.000109, 0.00366),
+               '18O':('O',17.999160, 0.00200),
+               '34S':('S',33.967867, 0.04215),
+               '41K':('K',40.961826, 0.06730)}
+
+#The isotopologues held in each dictionary, as (name, isotope, number of heavy atoms). The name is the suffix of their mass and abundance columns.
+isotopologues = [("13C1","13C",1),
+                 ("13C2","13C",2),
+                 ("34S","34S",1),
+                 ("18O","18O",1),
+                 ("15N","15N",1),
+                 ("41K","41K",1)]
+
+#The exact mass shift of each isotopologue from its monoisotopic ion, as name: (shift, element, number of heavy atoms).
+#isotopes is a list of (name, isotope, number of heavy atoms), as isotopologues - the shifts are those of the isotopologue columns of the dictionaries.
+def isotopeshifts(isotopes, chemdict=chemdict):
+    shifts = {}
+    for name, isotope, count in isotopes:
+        element, isotopemass, isotopeabundance = isotopedict[isotope]
+        shifts[name] = (count * (isotopemass - chemdict[element][0]), element, count)
+    return shifts
+
+#################################################
+# This section is important.
+# Here you define your elemental limits.
+# In short - if you have tight limits, you'll get faster results.
+# Broad limits - longer calculations and risk of multiple possible assignments in the next script. Not tested fully at high limits.
+# CHONS limits were derived from the literature, however the following negative mode limits have been  tightened for the samples our group looks at
+# for example, fulvic acids and scotch whisky. 
+# See, for example, Kew, W., Goodall, I., Clarke, D., Uhrin, D.
+#                   "Chemical Diversity and Complexity of Scotch Whisky as Revealed by High-Resolution Mass Spectrometry" 
+#                   J. Am. Soc. Mass Spectrom., 2016. doi:10.1007/s13361-016-1513-y
+#################################################
+
+def elementallimits(low,high,mode):
+    if mode == "negative":
+        if high < 500:
+            maxC = 29 #numbers based on paper
+            maxH = 72
+            maxO = 18
+            maxN = 0
+            maxS = 2#1 #max S found in Whisky was 1
+            maxP = 0
+            maxNa = 0
+            maxK = 0
+        elif 500 <= high <= 1000:
+            maxC = 66
+            maxH = 126
+            maxO = 27
+            maxN = 0
+            maxS = 2#1 #max S found in Whisky was 1 
+            maxP = 0
+            maxNa = 0
+            maxK = 0
+        elif high > 1000: #up to 2000 m/z, following the seven golden rules limits for that range
+            maxC = 145
+            maxH = 236
+            maxO = 63
+            maxN = 0
+            maxS = 2
+            maxP = 0
+            maxNa = 0
+            maxK = 0
+            
+    elif mode == "positive": #these numbers are quite broad, based on seven golden rules (etc). on  you may need to tailor to your appication - many possible formulae!
+        if high < 500:
+            maxC = 29
+            maxH = 72
+            maxO = 18
+            maxN = 0#10
+            maxS = 0#7
+            maxP = 0
+            maxNa = 1
+            maxK = 0
+        elif 500 <= high < 1000:
+            maxC = 66
+            maxH = 126
+            maxO = 27
+            maxN = 0#10
+            maxS = 0#4
+            maxP = 0
+            maxNa = 1
+            maxK = 0
+        elif high >= 1000: #as for negative mode
+            maxC = 145
+            maxH = 236
+            maxO = 63
+            maxN = 0
+            maxS = 0
+            maxP = 0
+            maxNa = 1
+            maxK = 0
+    return maxC, maxH, maxO, maxN, maxS,maxP, maxNa, maxK
+
+
+#These are the element count columns of a formula dictionary, in the order they are written out.
+formulafields = ["C","H","O","N","S","P","Na","K"]
+
+#Typed record for one generated formula - this is also the layout of the binary (.npy) dictionaries.
+#homo is held as an integer code (see homocode), the homo string is only built when a csv dictionary is written out.
+#Each formula also carries its isotopologues (see isotopologues above): the mass, and the abundance relative to the monoisotopic ion.
+#An isotopologue the formula cannot have (e.g. 34S without S) has a NaN mass and zero abundance.
+isotopologuefields = [x+name for name, isotope, count in isotopologues for x in ["mass","abundance"]]
+formuladtype = np.dtype([("mass","f8"),("abundance","f8")]+[(x,"i2") for x in formulafields]+[("homo","i4"),("homoval","i2")]+[(x,"f8") for x in isotopologuefields])
+
+#Integer version of the homo string (O, N, S, P counts). Two digits per element, so unlike the string it is never ambiguous, e.g. O12 vs O1N2.
+def homocode(o,n,s,p):
+    return o*1000000 + n*10000 + s*100 + p
+
+#The elemental ratio rules (rules 4-6 from Seven Golden Rules, "99.7% common range") applied to every candidate formula.
+#HC is an open (low, high) range, the others are open upper limits. Hetero caps the total O+N+S+P count at this multiple of C.
+formularules = {"HC":(0.2,3.1),
+                "OC":1.2,
+                "NC":1.3,
+                "SC":0.8,
+                "Hetero":1.3}
+
+#Every rule a candidate formula can be rejected by, in the order they are applied by default. HC, OC, NC and SC are tested on each element axis
+#(see formulaaxes), Bound is the pruning of the mass directed mode, and Nrule (nitrogen rule/adducts), Hetero and Window are tested per formula.
+formularulenames = ["HC","OC","NC","SC","Bound","Nrule","Hetero","Window"]
+
+#The per formula rules, which can be run in any order, with their relative cost - the window needs the mass of every formula it tests.
+rowrulecosts = {"Nrule":1.0,
+                "Hetero":1.0,
+                "Window":3.0}
+
+#Counters of the candidates each rule tested and rejected, as {rule: [tested, rejected]}.
+def newrulestats():
+    return {x:[0,0] for x in formularulenames}
+
+def countrule(stats, rule, tested, passed):
+    if stats is not None:
+        stats[rule][0] += int(tested)
+        stats[rule][1] += int(tested - passed)
+
+def addrulestats(total, stats):
+    for rule in stats:
+        total[rule][0] += stats[rule][0]
+        total[rule][1] += stats[rule][1]
+    return total
+
+#Order to run the per formula rules in, given the counts so far - the rules which reject the largest share of what they test, for their cost, go first.
+#The rules are all applied, so the order never changes which formulae come out, only how many candidates the later rules have to test.
+def ruleorder(stats):
+    def strength(rule):
+        tested, rejected = stats[rule]
+        return (rejected / float(tested) if tested > 0 else 0.0) / rowrulecosts[rule]
+    if stats is None:
+        return list(rowrulecosts)
+    return sorted(rowrulecosts, key=lambda x: -strength(x))
+
+#A printable summary of rule counters, one line per rule which tested anything.
+def rulestatsreport(stats):
+    lines = []
+    for rule in formularulenames:
+        tested, rejected = stats[rule]
+        if tested > 0:
+            lines.append("    " + rule + ": tested " + str(tested) + ", rejected " + str(rejected) + " (" + str(round(100.0*rejected/tested,1)) + "%)")
+    return "\n".join(lines)
+
+#Raises a natural abundance to each of an array of (small, non-negative) element counts.
+#The powers are taken from a table built with python floats so they match getabun in 0-FormulaGenerator to the last digit.
+def powertable(abundance,counts):
+    if len(counts) == 0:
+        return np.ones(0)
+    table = np.array([abundance ** i for i in range(int(counts.max())+1)])
+    return table[counts]
+
+#This gives the element counts to be tried for a single carbon number, one array per element in loop order (H, P, O, N, S, Na, K).
+#Each ratio rule that depends on one element only is applied to that element's axis here, so a block never holds e.g. a rejected H/C ratio.
+#If stats is given, the candidates of the whole elemental box each rule tests and rejects are counted into it (see newrulestats).
+def formulaaxes(c,maxH,maxO,maxN,maxS,maxP,maxNa,maxK,mode,stats=None):
+    h = np.arange(1,int(maxH))
+    p = np.arange(int(maxP)+1)
+    if mode == "negative":
+        o = np.arange(1,int(maxO)) #negative mode formulae must contain at least one oxygen
+        na = np.zeros(1,dtype=int)
+        k = np.zeros(1,dtype=int)
+    else:
+        o = np.arange(int(maxO))
+        na = np.arange(int(maxNa)+1)
+        k = np.arange(int(maxK)+1)
+    n = np.arange(int(maxN)+1)
+    s = np.arange(int(maxS)+1)
+    def boxsize():
+        return int(np.prod([len(x) for x in (h,p,o,n,s,na,k)]))
+    tested = boxsize()
+    hcrat = h/float(c)
+    h = h[(formularules["HC"][0] < hcrat) & (hcrat < formularules["HC"][1])]
+    countrule(stats,"HC",tested,boxsize())
+    tested = boxsize()
+    o = o[o/float(c) < formularules["OC"]]
+    countrule(stats,"OC",tested,boxsize())
+    tested = boxsize()
+    n = n[n/float(c) < formularules["NC"]]
+    countrule(stats,"NC",tested,boxsize())
+    tested = boxsize()
+    s = s[s/float(c) < formularules["SC"]]
+    countrule(stats,"SC",tested,boxsize())
+    return h,p,o,n,s,na,k
+
+#The cost of a carbon number is the size of its block, i.e. the number of candidates the masks below have to test.
+def formulablockcost(c,maxH,maxO,maxN,maxS,maxP,maxNa,maxK,mode):
+    return int(np.prod([len(x) for x in formulaaxes(c,maxH,maxO,maxN,maxS,maxP,maxNa,maxK,mode)]))
+
+#This builds the blocks of formulae for a single carbon number as integer arrays, rather than the nested loops of the original calculator.
+#The rules which need more than one element (nitrogen rule/adducts, heteroatom count and mass window) are applied as masks over the whole block.
+#Rows come out in the same order as the loops in 0-FormulaGenerator (H, P, O, N, S, Na, K), and masses are summed in the same order so they are identical.
+#If maxrows is given, the H axis is split so that no block tests more than maxrows candidates (but always at least one H count) - this bounds memory.
+#If bounded is True, each block is built by the mass directed boundedformulablock instead of the full grid.
+#If stats is given, every rule's tested and rejected counts are added to it. If adaptive is True, the per formula rules of each block are run in
+#the order given by ruleorder for the counts so far, so the strongest cheap cuts are made first - the formulae which come out are the same.
+def formulablocks(c,maxH,maxO,maxN,maxS,maxP,maxNa,maxK,low,high,mode,chemdict,maxrows=None,bounded=False,adaptive=False,stats=None):
+    axes = formulaaxes(c,maxH,maxO,maxN,maxS,maxP,maxNa,maxK,mode,stats)
+    rest = int(np.prod([len(x) for x in axes[1:]]))
+    if len(axes[0]) == 0 or rest == 0:
+        return
+    step = len(axes[0]) if maxrows is None else max(1, int(maxrows) // rest)
+    for start in range(0,len(axes[0]),step):
+        order = ruleorder(stats) if adaptive else None
+        if bounded:
+            block = boundedformulablock(c,(axes[0][start:start+step],)+axes[1:],low,high,mode,chemdict,stats,order)
+        else:
+            block = maskedformulablock(c,(axes[0][start:start+step],)+axes[1:],low,high,mode,chemdict,stats,order)
+        if len(block) > 0:
+            yield block
+
+#Builds the grid of all combinations of the given element axes and keeps those which pass the remaining rules.
+def maskedformulablock(c,axes,low,high,mode,chemdict,stats=None,order=None):
+    h,p,o,n,s,na,k = [x.ravel() for x in np.meshgrid(*axes,indexing="ij")]
+    return formularows(c,h,p,o,n,s,na,k,low,high,mode,chemdict,stats,order)
+
+#Mass directed (branch and bound) version of maskedformulablock. Rather than the whole grid, the compositions are grown one element at a time,
+#in loop order, and at each level only the counts which can still land in the window - given the mass so far and the lightest and heaviest
+#the remaining elements could be - are visited. The survivors then go through exactly the same rules, so the same formulae come out, in the same order.
+def boundedformulablock(c,axes,low,high,mode,chemdict,stats=None,order=None):
+    if mode == "negative":
+        start = chemdict['C'][0] * c + chemdict['e'][0]
+    else:
+        start = chemdict['C'][0] * c - chemdict['e'][0]
+    rows = boundedexpansion(start,axes,[chemdict[x][0] for x in ["H","P","O","N","S","Na","K"]],low,high)
+    countrule(stats,"Bound",np.prod([len(x) for x in axes]),0 if rows is None else len(rows[0]))
+    if rows is None:
+        return np.zeros(0,dtype=formuladtype)
+    h,p,o,n,s,na,k = rows
+    return formularows(c,h,p,o,n,s,na,k,low,high,mode,chemdict,stats,order)
+
+#The expansion behind boundedformulablock. Starting from a single partial formula of mass start, each axis (sorted element counts, with mass
+#masses[i] each) is added in turn, keeping only the counts which can still reach (low, high). The rows are expanded as ragged arrays, so they
+#stay in loop order. Returns one array of counts per axis, or None if nothing can reach the window.
+def boundedexpansion(start,axes,masses,low,high):
+    minrest = [sum(masses[j]*axes[j][0] for j in range(i+1,len(axes))) for i in range(len(axes))]
+    maxrest = [sum(masses[j]*axes[j][-1] for j in range(i+1,len(axes))) for i in range(len(axes))]
+    slack = 1e-6 #Da - only ever lets slightly too many through the bounds, the exact mass window is applied at the end.
+    partial = np.full(1,start)
+    rows = []
+    for i, axis in enumerate(axes):
+        first = np.searchsorted(axis,(low - slack - partial - maxrest[i])/masses[i],side="left")
+        last = np.searchsorted(axis,(high + slack - partial - minrest[i])/masses[i],side="right")
+        counts = np.maximum(last - first, 0)
+        parent = np.repeat(np.arange(len(partial)),counts)
+        starts = np.cumsum(counts) - counts
+        values = axis[np.repeat(first,counts) + np.arange(parent.size) - np.repeat(starts,counts)]
+        rows = [x[parent] for x in rows] + [values]
+        partial = partial[parent] + masses[i]*values
+        if partial.size == 0:
+            return None
+    return rows
+
+#Applies the rules which need more than one element to flat arrays of element counts (for one carbon number), and builds the typed block.
+#The rules are run in order (by default that of rowrulecosts), each only testing the survivors of the last. If stats is given, they are counted into it.
+def formularows(c,h,p,o,n,s,na,k,low,high,mode,chemdict,stats=None,order=None):
+    homoval = o + n + s + p
+    mass = None
+    for rule in (order or rowrulecosts):
+        if rule == "Nrule":
+            if mode == "negative": #N rule - odd H with even N, or even H with odd N
+                keep = (h + n) % 2 == 1
+            else: #N rule - an even H+N count needs exactly one Na or K adduct, odd H+N must be protonated
+                adduct = ((na == 1) & (k == 0)) | ((na == 0) & (k == 1))
+                keep = np.where((h + n) % 2 == 0, adduct, (na == 0) & (k == 0))
+        elif rule == "Hetero":
+            keep = (0 < homoval) & (homoval < (c*formularules["Hetero"]))
+        elif rule == "Window":
+            if mass is None:
+                mass = ionmass(c,h,p,o,n,s,na,k,mode,chemdict)
+            keep = (low < mass) & (mass < high)
+        countrule(stats,rule,len(keep),np.count_nonzero(keep))
+        h,p,o,n,s,na,k,homoval = [x[keep] for x in (h,p,o,n,s,na,k,homoval)]
+        if mass is not None:
+            mass = mass[keep]
+    return formularecords(c,h,p,o,n,s,na,k,homoval,mass,chemdict)
+
+#The mass of an ion, summed in exactly the same order as getmass in 0-FormulaGenerator.
+def ionmass(c,h,p,o,n,s,na,k,mode,chemdict):
+    mass = chemdict['C'][0] * c + chemdict['H'][0] * h + chemdict['O'][0] * o + chemdict['N'][0] * n + chemdict['S'][0] * s
+    if mode == "negative":
+        return mass + chemdict['P'][0] * p + chemdict['e'][0] * 1
+    return mass + chemdict['P'][0] * p + chemdict['Na'][0] * na + chemdict['K'][0] * k - chemdict['e'][0] * 1
+
+#Builds the typed block for formulae which have passed all of the rules.
+def formularecords(c,h,p,o,n,s,na,k,homoval,mass,chemdict):
+    block = np.zeros(len(mass),dtype=formuladtype)
+    block["mass"] = mass
+    block["abundance"] = (chemdict['C'][1] ** c) * powertable(chemdict['H'][1],h) * powertable(chemdict['O'][1],o) * powertable(chemdict['N'][1],n) * powertable(chemdict['S'][1],s)
+    for name, values in zip(formulafields,(c,h,o,n,s,p,na,k)):
+        block[name] = values
+    block["homo"] = homocode(o,n,s,p)
+    block["homoval"] = homoval
+    return setisotopologues(block,chemdict)
+
+#Fills in the isotopologue columns of a typed block from its element counts and monoisotopic masses.
+#The relative abundance of swapping in count heavy atoms, out of the n atoms of that element, is binomial: (n choose count) * (heavy/light)^count.
+def setisotopologues(block, chemdict):
+    for name, isotope, count in isotopologues:
+        element, isotopemass, isotopeabundance = isotopedict[isotope]
+        atoms = block[element].astype("f8")
+        possible = block[element] >= count
+        ways = np.ones(len(block))
+        for i in range(count):
+            ways = ways * (atoms - i) / (i + 1)
+        block["mass"+name] = np.where(possible, block["mass"] + count * (isotopemass - chemdict[element][0]), np.nan)
+        block["abundance"+name] = np.where(possible, ways * (isotopeabundance / chemdict[element][1]) ** count, 0.0)
+    return block
+
+#Turns rows of (mass, abundance, C, H, O, N, S, P, Na, K, homo code, homoval) - as built by the loop calculators - into a typed block.
+def formulachunk(rows, chemdict):
+    block = np.zeros(len(rows),dtype=formuladtype)
+    fields = ["mass","abundance"]+formulafields+["homo","homoval"]
+    if len(rows) > 0:
+        columns = list(zip(*rows))
+        for i, name in enumerate(fields):
+            block[name] = columns[i]
+    return setisotopologues(block,chemdict)
+
+#The loop calculators clip the predefined maxima by the upper mass of the window - we do exactly the same.
+def clippedlimits(maxC, maxH, maxO, high):
+    maxC = min((int(high) / 12), maxC) #the max carbon count has to be the smaller of the total mass/12 or predefined maxC
+    maxH = min((maxC * 4), maxH) #max hydrogen count is the smaller of 4 times the number of carbons or the predefined max hydrogen number.
+    maxO = min((int(high) / 16), maxO) #the max oxygen count has to be the smaller of the total mass/16 or predefined maxO
+    return maxC, maxH, maxO
+
+#Builds the blocks for carbon numbers cstart to cstop-1, in carbon order, i.e. still in loop order. Each block tests at most maxrows candidates.
+def carbonslice_chunks(cstart, cstop, maxH, maxO, maxN, maxS, maxP, maxNa, maxK, low, high, mode, chemdict, maxrows=None, bounded=False, adaptive=False, stats=None):
+    for c in range(cstart,cstop):
+        for block in formulablocks(c,maxH,maxO,maxN,maxS,maxP,maxNa,maxK,low,high,mode,chemdict,maxrows,bounded,adaptive,stats):
+            yield block
+
+#As carbonslice_chunks, but joined into a single array.
+def carbonslice_form_calc(cstart, cstop, maxH, maxO, maxN, maxS, maxP, maxNa, maxK, low, high, mode, chemdict, bounded=False, adaptive=False, stats=None):
+    blocks = list(carbonslice_chunks(cstart,cstop,maxH,maxO,maxN,maxS,maxP,maxNa,maxK,low,high,mode,chemdict,None,bounded,adaptive,stats))
+    if len(blocks) == 0:
+        return np.zeros(0,dtype=formuladtype)
+    return np.concatenate(blocks)
+
+#Vectorised equivalent of pos_form_calc/neg_form_calc in 0-FormulaGenerator. Streams the formulae of a window as typed chunks, in loop order (not sorted).
+#The element maxima are clipped exactly as the loop calculators do, so the same limits give exactly the same rows.
+#No chunk tests more than chunkrows candidates, so memory stays bounded. The rule counters (stats) are filled in as the chunks are consumed.
+def vector_form_chunks(maxC, maxH, maxO, maxN, maxS, maxP, maxNa, maxK, low, high, mode, chemdict, chunkrows=None, bounded=False, adaptive=False, stats=None):
+    maxC, maxH, maxO = clippedlimits(maxC, maxH, maxO, high)
+    return carbonslice_chunks(1,int(maxC),maxH,maxO,maxN,maxS,maxP,maxNa,maxK,low,high,mode,chemdict,chunkrows,bounded,adaptive,stats)
+
+#This splits each window into slices of its carbon range, each with a cost estimate, ready to be handed out to a pool of processes.
+#windows is a list of (low, high, (maxC, maxH, maxO, maxN, maxS, maxP, maxNa, maxK)). Slices aim to cost about total/slicespertask each,
+#so the big high mass windows are broken up and the small ones stay whole. No slice is allowed to grow beyond maxcost, unless it is a single carbon number.
+def formulatasks(windows, mode, chemdict, slicespertask, maxcost=None, bounded=False, adaptive=False):
+    costs = []
+    for low, high, limits in windows:
+        maxC, maxH, maxO = clippedlimits(limits[0], limits[1], limits[2], high)
+        costs.append([formulablockcost(c,maxH,maxO,limits[3],limits[4],limits[5],limits[6],limits[7],mode) for c in range(1,int(maxC))])
+    target = max(1, sum(sum(x) for x in costs) // max(1,slicespertask))
+    if maxcost is not None:
+        target = min(target, maxcost)
+    tasks = []
+    for w, (low, high, limits) in enumerate(windows):
+        maxC, maxH, maxO = clippedlimits(limits[0], limits[1], limits[2], high)
+        cstart, cost = 1, 0
+        for c, ccost in enumerate(costs[w], start=1):
+            cost += ccost
+            nextcost = costs[w][c] if c < len(costs[w]) else 0
+            if cost >= target or cost + nextcost > target or c == len(costs[w]):
+                tasks.append((cost, w, (cstart, c+1, maxH, maxO)+tuple(limits[3:])+(low, high, mode, chemdict, bounded, adaptive)))
+                cstart, cost = c+1, 0
+    return tasks
+
+#Calculates one slice for the process pool, sorts it by mass and saves it as a sorted run (see mergeruns).
+#Only the file name and the slice's rule counters go back to the parent.
+def formularuntask(args):
+    task, runfile = args
+    stats = newrulestats()
+    x = carbonslice_form_calc(*task, stats=stats)
+    savebinarydictionary(x[np.argsort(x["mass"],kind="mergesort")],runfile)
+    return runfile, stats
+
+#Calculates the formulae for every window across a pool of processes. Returns, for each window, the list of its sorted runs (in carbon order),
+#ready for mergeruns. Each slice is held in memory by one worker only, and is never more than about chunkrows candidates.
+#Slices are submitted most expensive first (longest processing time first scheduling), so no worker is left with a big slice at the end.
+#Each window's runs are merged in carbon order, so the output is identical to a serial run whatever the number of workers.
+#If stats is given (a list of rule counters, one per window), each window's slices are counted into it. With adaptive, each slice orders its own rules.
+def parallel_form_runs(windows, mode, chemdict, tmpdir, nworkers=None, chunkrows=None, bounded=False, adaptive=False, stats=None):
+    from concurrent.futures import ProcessPoolExecutor
+    nworkers = nworkers or os.cpu_count() or 1
+    tasks = formulatasks(windows, mode, chemdict, 4*nworkers, chunkrows, bounded, adaptive)
+    order = sorted(range(len(tasks)), key=lambda i: -tasks[i][0])
+    runfiles = [os.path.join(tmpdir,mode[:3]+"-window"+str(tasks[i][1])+"-C"+str(tasks[i][2][0])+".npy") for i in range(len(tasks))] #one tmpdir may hold both modes' runs
+    with ProcessPoolExecutor(max_workers=nworkers) as pool:
+        for i, (runfile, slicestats) in zip(order, pool.map(formularuntask, [(tasks[i][2],runfiles[i]) for i in order])):
+            if stats is not None:
+                addrulestats(stats[tasks[i][1]],slicestats)
+    runs = [[] for x in windows]
+    for i in range(len(tasks)): #tasks are already in carbon order within each window
+        runs[tasks[i][1]].append(runfiles[i])
+    return runs
+
+#The ions we make from a neutral molecule M: their mode, then the change in H, the Na and K added, and the charge.
+#Adding a new adduct is just a new line here - its mass offset from M is worked out by adductoffset.
+adductdict = {"[M-H]-":("negative",-1,0,0,-1),
+              "[M+H]+":("positive",1,0,0,1),
+              "[M+Na]+":("positive",0,1,0,1),
+              "[M+K]+":("positive",0,0,1,1)}
+
+#Mass added to a neutral molecule to make this adduct. The charge comes from losing (positive) or gaining (negative) an electron.
+def adductoffset(adduct, chemdict):
+    mode, dh, na, k, charge = adductdict[adduct]
+    return chemdict['H'][0]*dh + chemdict['Na'][0]*na + chemdict['K'][0]*k - chemdict['e'][0]*charge
+
+#The adducts which make up a mode's dictionary for these limits, i.e. Na and K adducts only if maxNa and maxK allow them.
+def modeadducts(mode, limits):
+    return [x for x in adductdict if adductdict[x][0] == mode and adductdict[x][2] <= limits[6] and adductdict[x][3] <= limits[7]]
+
+#This enumerates the neutral molecules for a single carbon number once, and derives every mode's ions from them.
+#modelimits is {mode: (maxC, maxH, maxO, maxN, maxS, maxP, maxNa, maxK)} for a window (low, high). The neutral molecules are built over the union of
+#the limits, with the mass directed expansion over a window widened by the adduct offsets. Each adduct's ions are then one array addition (H, Na, K counts)
+#away, and the rules which depend on the ion (H count and H/C ratio, each mode's own limits and the mass window) are applied per adduct.
+#Every ion the per mode calculators allow comes from a neutral molecule with an even H+N count (the N rule), so exactly the same formulae come out.
+#Masses are summed in the same order as ionmass, and each block is put in loop order, so the dictionaries are identical too.
+#Returns {mode: typed block}.
+def neutralformulablocks(c, modelimits, low, high, chemdict):
+    active = {}
+    for mode in modelimits:
+        maxC, maxH, maxO = clippedlimits(modelimits[mode][0], modelimits[mode][1], modelimits[mode][2], high)
+        if c < int(maxC):
+            active[mode] = (maxH, maxO, modeadducts(mode, modelimits[mode]))
+    blocks = {mode:np.zeros(0,dtype=formuladtype) for mode in modelimits}
+    adducts = [(mode, x) for mode in active for x in active[mode][2]]
+    if len(adducts) == 0:
+        return blocks
+    hlow = min(1 - adductdict[x][1] for mode, x in adducts)
+    hhigh = max(int(active[mode][0]) - 1 - adductdict[x][1] for mode, x in adducts)
+    omin = min(1 if mode == "negative" else 0 for mode in active) #negative mode formulae must contain at least one oxygen
+    h = np.arange(max(0,hlow),hhigh+1)
+    p = np.arange(max(modelimits[mode][5] for mode in active)+1)
+    o = np.arange(omin,max(int(active[mode][1]) for mode in active))
+    o = o[o/float(c) < formularules["OC"]]
+    n = np.arange(max(modelimits[mode][3] for mode in active)+1)
+    n = n[n/float(c) < formularules["NC"]]
+    s = np.arange(max(modelimits[mode][4] for mode in active)+1)
+    s = s[s/float(c) < formularules["SC"]]
+    if min(len(h),len(p),len(o),len(n),len(s)) == 0:
+        return blocks
+    offsets = [adductoffset(x, chemdict) for mode, x in adducts]
+    rows = boundedexpansion(chemdict['C'][0] * c,(h,p,o,n,s),[chemdict[x][0] for x in ["H","P","O","N","S"]],low-max(offsets),high-min(offsets))
+    if rows is None:
+        return blocks
+    h,p,o,n,s = rows
+    homoval = o + n + s + p
+    keep = ((h + n) % 2 == 0) & (0 < homoval) & (homoval < (c*formularules["Hetero"]))
+    h,p,o,n,s,homoval = [x[keep] for x in (h,p,o,n,s,homoval)]
+    for mode in active:
+        maxH, maxO, modeadduct = active[mode]
+        limits = modelimits[mode]
+        parts = []
+        for x in modeadduct:
+            dh, na, k = adductdict[x][1:4]
+            hion = h + dh
+            hcrat = hion/float(c)
+            keep = (1 <= hion) & (hion < int(maxH)) & (formularules["HC"][0] < hcrat) & (hcrat < formularules["HC"][1])
+            keep &= (o < int(maxO)) & (p <= limits[5]) & (n <= limits[3]) & (s <= limits[4])
+            if mode == "negative":
+                keep &= o >= 1
+            nas = np.full(np.count_nonzero(keep),na)
+            ks = np.full(np.count_nonzero(keep),k)
+            mass = ionmass(c,hion[keep],p[keep],o[keep],n[keep],s[keep],nas,ks,mode,chemdict)
+            inwindow = (low < mass) & (mass < high)
+            parts.append(formularecords(c,hion[keep][inwindow],p[keep][inwindow],o[keep][inwindow],n[keep][inwindow],s[keep][inwindow],nas[inwindow],ks[inwindow],homoval[keep][inwindow],mass[inwindow],chemdict))
+        block = np.concatenate(parts)
+        blocks[mode] = block[np.lexsort([block[x] for x in ["K","Na","S","N","O","P","H"]])] #back into loop order
+    return blocks
+
+#Calculates one carbon slice of a window from the neutral molecules, for the process pool, and saves each mode's formulae as a sorted run.
+def neutralruntask(args):
+    cstart, cstop, modelimits, low, high, chemdict, runfiles = args
+    blocks = {mode:[] for mode in modelimits}
+    for c in range(cstart,cstop):
+        for mode, block in neutralformulablocks(c, modelimits, low, high, chemdict).items():
+            blocks[mode].append(block)
+    for mode in modelimits:
+        x = np.concatenate(blocks[mode]) if len(blocks[mode]) > 0 else np.zeros(0,dtype=formuladtype)
+        savebinarydictionary(x[np.argsort(x["mass"],kind="mergesort")],runfiles[mode])
+    return runfiles
+
+#Calculates the dictionaries of several modes together, from one enumeration of neutral molecules (see neutralformulablocks).
+#windowsbymode is {mode: [(low, high, limits), ...]}, with the same windows for every mode. Returns {mode: [sorted runs of each window]}, ready for mergeruns.
+#Slices of each window's carbon range are spread over a pool of processes as in parallel_form_runs (or all run here, if nworkers is 1).
+def neutral_form_runs(windowsbymode, chemdict, tmpdir, nworkers=None, chunkrows=None):
+    modes = list(windowsbymode)
+    windows = windowsbymode[modes[0]]
+    union = [(low, high, tuple(max(windowsbymode[mode][w][2][i] for mode in modes) for i in range(8))) for w, (low, high, limits) in enumerate(windows)]
+    nworkers = nworkers or os.cpu_count() or 1
+    tasks = formulatasks(union, "positive", chemdict, 4*nworkers, chunkrows)
+    args = []
+    for cost, w, task in tasks:
+        modelimits = {mode:tuple(windowsbymode[mode][w][2]) for mode in modes}
+        runfiles = {mode:os.path.join(tmpdir,mode[:3]+"-window"+str(w)+"-C"+str(task[0])+".npy") for mode in modes}
+        args.append((task[0], task[1], modelimits, windows[w][0], windows[w][1], chemdict, runfiles))
+    if nworkers == 1:
+        list(map(neutralruntask, args))
+    else:
+        from concurrent.futures import ProcessPoolExecutor
+        order = sorted(range(len(tasks)), key=lambda i: -tasks[i][0])
+        with ProcessPoolExecutor(max_workers=nworkers) as pool:
+            list(pool.map(neutralruntask, [args[i] for i in order]))
+    runs = {mode:[[] for x in windows] for mode in modes}
+    for i in range(len(tasks)): #tasks are already in carbon order within each window
+        for mode in modes:
+            runs[mode][tasks[i][1]].append(args[i][6][mode])
+    return runs
+
+#This is the first half of the external merge sort. Typed chunks are gathered until there are chunkrows rows,
+#sorted by mass and written to tmpdir as a sorted run. Returns the list of run files, in the order of the chunks.
+def sortedruns(chunks, chunkrows, tmpdir, prefix="run"):
+    runs, buffered, nbuffered = [], [], 0
+    def spill():
+        x = np.concatenate(buffered) if len(buffered) > 0 else np.zeros(0,dtype=formuladtype)
+        runs.append(savebinarydictionary(x[np.argsort(x["mass"],kind="mergesort")],os.path.join(tmpdir,prefix+"-"+str(len(runs))+".npy")))
+    for chunk in chunks:
+        buffered.append(chunk)
+        nbuffered += len(chunk)
+        if nbuffered >= chunkrows:
+            spill()
+            buffered, nbuffered = [], 0
+    if nbuffered > 0 or len(runs) == 0:
+        spill()
+    return runs
+
+#Total number of formulae held in a list of runs.
+def runrows(runs):
+    return sum(len(np.load(x,mmap_mode="r")) for x in runs)
+
+#This is the second half of the external merge sort - a k-way merge of the sorted runs, yielding sorted typed blocks.
+#Each run is memory-mapped and read a block at a time, so only about chunkrows rows are held in memory whatever the size of the dictionary.
+#Rows are only given out once they are below the last row read from every unfinished run, so nothing smaller can still be waiting.
+#Ties are kept in run order, so the result is exactly that of one stable sort over all the chunks.
+def mergeruns(runs, chunkrows):
+    runs = [np.load(x,mmap_mode="r") for x in runs]
+    blockrows = max(1, int(chunkrows) // (len(runs)+1))
+    positions = [0 for x in runs]
+    buffers = [np.zeros(0,dtype=formuladtype) for x in runs]
+    def refill(r):
+        buffers[r] = np.concatenate((buffers[r],np.array(runs[r][positions[r]:positions[r]+blockrows])))
+        positions[r] = min(positions[r]+blockrows,len(runs[r]))
+    for r in range(len(runs)):
+        refill(r)
+    while any(len(x) > 0 for x in buffers):
+        unfinished = [r for r in range(len(runs)) if positions[r] < len(runs[r])]
+        cutoff = min([buffers[r]["mass"][-1] for r in unfinished]) if len(unfinished) > 0 else np.inf
+        taken = [x[x["mass"] < cutoff] for x in buffers]
+        if sum(len(x) for x in taken) == 0 and len(unfinished) > 0: #everything left in the limiting run's buffer equals the cutoff - read further into it.
+            for r in unfinished:
+                if buffers[r]["mass"][-1] == cutoff:
+                    refill(r)
+            continue
+        buffers = [x[x["mass"] >= cutoff] for x in buffers]
+        block = np.concatenate(taken)
+        yield block[np.argsort(block["mass"],kind="mergesort")]
+        for r in unfinished:
+            if len(buffers[r]) == 0:
+                refill(r)
+
+#Writes a dictionary from sorted typed blocks, as a csv dictionary and, if npyfile is given, a binary dictionary with total rows.
+#Nothing but the current block is held in memory. Both are written to temporary files and moved into place at the end.
+def writedictionary(blocks, total, csvfile, npyfile=None):
+    if npyfile is not None:
+        x = np.lib.format.open_memmap(npyfile+".tmp",mode="w+",dtype=formuladtype,shape=(total,))
+    written = 0
+    with open(csvfile+".tmp","w",newline="") as f:
+        formulaframe(np.zeros(0,dtype=formuladtype)).to_csv(f,index=False)
+        for block in blocks:
+            formulaframe(block).to_csv(f,index=False,header=False)
+            if npyfile is not None:
+                x[written:written+len(block)] = block
+            written += len(block)
+    os.replace(csvfile+".tmp",csvfile)
+    if npyfile is not None:
+        x.flush()
+        del x
+        os.replace(npyfile+".tmp",npyfile)
+    return written
+
+#Picks nwindows dictionary windows between low and high, cut at whole m/z values, so that each window holds about the same number of formulae.
+#dictionaries are dictionary files which are each sorted by mass and together hold every formula between low and high.
+#The formulae are counted per 1 m/z bin (a chunk at a time), and each cut is put at the bin edge nearest an equal share of the total.
+#Returns a list of (low, high, rows), where a window holds low <= mass < high.
+def equalcountwindows(dictionaries, low, high, nwindows, chunkrows=1000000):
+    low, high = int(low), int(high)
+    counts = np.zeros(high-low,dtype=np.int64)
+    for filename in dictionaries:
+        x = loaddictionary(filename)
+        for i in range(0,len(x),int(chunkrows)):
+            bins = np.floor(x["mass"][i:i+int(chunkrows)]).astype(np.int64) - low
+            counts += np.bincount(np.clip(bins,0,len(counts)-1),minlength=len(counts))
+    below = np.concatenate(([0],np.cumsum(counts))) #below[b] is the number of formulae under low+b
+    nwindows = max(1,min(int(nwindows),len(counts)))
+    cuts = [0]
+    for i in range(1,nwindows):
+        target = below[-1] * i / float(nwindows)
+        b = int(np.searchsorted(below,target))
+        if b > 0 and target - below[b-1] < below[min(b,len(below)-1)] - target:
+            b = b - 1
+        b = min(max(b,cuts[-1]+1),len(counts)-(nwindows-i)) #every window at least 1 m/z wide
+        cuts.append(b)
+    cuts.append(len(counts))
+    return [(low+cuts[i],low+cuts[i+1],int(below[cuts[i+1]]-below[cuts[i]])) for i in range(nwindows)]
+
+#Yields the formulae with low <= mass < high from dictionaries (as for equalcountwindows), as sorted typed blocks of at most chunkrows rows.
+def windowblocks(dictionaries, low, high, chunkrows=1000000):
+    for filename in dictionaries:
+        x = loaddictionary(filename)
+        start, stop = np.searchsorted(x["mass"],[low,high])
+        for i in range(start,stop,int(chunkrows)):
+            yield np.array(x[i:min(i+int(chunkrows),stop)])
+
+#The manifest lists the dictionary windows written to a folder - the file name, its m/z bounds and the number of formulae it holds.
+def writemanifest(filename, entries):
+    manifest = pd.DataFrame(entries,columns=["file","low","high","rows"])
+    manifest.to_csv(filename+".tmp",index=False)
+    os.replace(filename+".tmp",filename)
+    return manifest
+
+#Converts a typed formula array into the dictionary table written by 0-FormulaGenerator, building the homo strings (O, N, S, P counts).
+def formulaframe(x):
+    df = pd.DataFrame(x[["mass","abundance"]+formulafields])
+    df["homo"] = df["O"].astype(str) + df["N"].astype(str) + df["S"].astype(str) + df["P"].astype(str)
+    df["homoval"] = x["homoval"]
+    for name in isotopologuefields:
+        df[name] = x[name]
+    return df
+
+#The reverse of formulaframe - converts a dictionary table (e.g. read from a csv dictionary) into a typed formula array.
+#Dictionaries written before the isotopologue columns were added have them calculated here.
+def formulaarray(df, chemdict=chemdict):
+    x = np.zeros(len(df),dtype=formuladtype)
+    for name in ["mass","abundance"]+formulafields+["homoval"]:
+        x[name] = pd.to_numeric(df[name]).values
+    x["homo"] = homocode(x["O"].astype("i4"),x["N"].astype("i4"),x["S"].astype("i4"),x["P"].astype("i4"))
+    if all(name in df.columns for name in isotopologuefields):
+        for name in isotopologuefields:
+            x[name] = pd.to_numeric(df[name]).values
+        return x
+    return setisotopologues(x,chemdict)
+
+#The columns of csv dictionaries written without a header row, by their number of columns - as written by the generator (12 columns),
+#or by older versions of it without the P column (11 columns, such as the dictionaries in MassToFormula/dictionaries).
+headerlessdictionaries = {12:["mass","abundance","C","H","O","N","S","P","Na","K","homo","homoval"],
+                          11:["mass","abundance","C","H","O","N","S","Na","K","homo","homoval"]}
+
+#Reads a csv dictionary as a table. A dictionary without a header row (its first row is numbers) is read by column position, see headerlessdictionaries.
+def readdictionary(filename):
+    df = pd.read_csv(filename,float_precision="round_trip")
+    if "mass" in df.columns or not pd.to_numeric(pd.Series(df.columns),errors="coerce").notna().all():
+        return df
+    if len(df.columns) not in headerlessdictionaries:
+        raise ValueError(filename + " has no header row and " + str(len(df.columns)) + " columns, so can't be read as a formula dictionary - regenerate it with 0-FormulaGenerator.py")
+    df = pd.read_csv(filename,header=None,names=headerlessdictionaries[len(df.columns)],float_precision="round_trip")
+    for name in formulafields:
+        if name not in df.columns:
+            df[name] = 0
+    return df
+
+#Writes a typed formula array as a binary dictionary (.npy). Written to a temporary file and moved into place, so a reader never maps half a file.
+def savebinarydictionary(x, filename):
+    with open(filename+".tmp","wb") as f:
+        np.save(f,np.ascontiguousarray(x,dtype=formuladtype))
+    os.replace(filename+".tmp",filename)
+    return filename
+
+#The binary dictionary sitting alongside a csv dictionary, i.e. dict100.csv -> dict100.npy
+def binarydictionarypath(filename):
+    return os.path.splitext(filename)[0]+".npy"
+
+#Loads a formula dictionary as a typed array, sorted by mass.
+#Binary dictionaries are memory-mapped read-only, so loading costs next to nothing and several processes share the same pages.
+#Given a csv dictionary, the binary one alongside it is used if it is up to date - if not, the csv is read once and converted for next time.
+def loaddictionary(filename, convert=True):
+    binaryname = binarydictionarypath(filename)
+    if filename != binaryname and os.path.isfile(filename):
+        if not os.path.isfile(binaryname) or os.path.getmtime(binaryname) < os.path.getmtime(filename):
+            x = formulaarray(readdictionary(filename))
+            if not convert:
+                return x
+            try:
+                savebinarydictionary(x,binaryname)
+            except OSError: #e.g. a read only dictionary location - just use what we have read.
+                return x
+    x = np.load(binaryname,mmap_mode="r")
+    if x.dtype != formuladtype: #a binary dictionary from before the isotopologue columns
+        x = formulaarray(pd.DataFrame(np.asarray(x)))
+        if convert:
+            try:
+                savebinarydictionary(x,binaryname)
+            except OSError:
+                pass
+    return x
+
+#The formulae of a dictionary (sorted by mass) with low <= mass <= high, found by binary search over the mass column rather than a scan.
+#Returns a slice of the dictionary, so nothing is copied - a memory-mapped dictionary only reads the pages the range sits on.
+def dictionaryrange(x, low, high):
+    start = np.searchsorted(x["mass"],low,side="left")
+    stop = np.searchsorted(x["mass"],high,side="right")
+    return x[start:stop]
+
+#One candidate assignment from massjoin - the position of the peak, the position of the formula in the dictionary, and the error in ppm.
+matchdtype = np.dtype([("peak","i8"),("formula","i8"),("error","f8")])
+
+#Matches a whole array of peak masses against the mass column of a dictionary (sorted by mass) in one go - an interval join.
+#Each peak is paired with every formula within threshold (Da) of it, exactly as dictionaryrange would find them, and pairs whose error is
+#over threshppm are dropped. Returns a typed array of matches (see matchdtype), ordered by peak then by formula mass.
+#If stats is given, the number of formulae scanned (those within threshold, before the ppm test) is added to stats["scanned"].
+def massjoin(peaks, dictmass, threshold, threshppm, stats=None):
+    peaks = np.asarray(peaks,dtype="f8")
+    start = np.searchsorted(dictmass,peaks - threshold,side="left")
+    stop = np.searchsorted(dictmass,peaks + threshold,side="right")
+    counts = np.maximum(stop - start, 0)
+    if stats is not None:
+        stats["scanned"] = stats.get("scanned",0) + int(counts.sum())
+    peak = np.repeat(np.arange(len(peaks)),counts)
+    formula = np.repeat(start,counts) + np.arange(peak.size) - np.repeat(np.cumsum(counts) - counts,counts)
+    theoretical = np.asarray(dictmass[formula],dtype="f8")
+    error = ((peaks[peak] - theoretical)/theoretical)*1000000
+    keep = np.abs(error) <= threshppm
+    matches = np.zeros(np.count_nonzero(keep),dtype=matchdtype)
+    matches["peak"] = peak[keep]
+    matches["formula"] = formula[keep]
+    matches["error"] = error[keep]
+    return matches
+
+#The dictionary windows in a folder, as a list of (filename, low, high) in mass order. They are read from the manifest written by 0-FormulaGenerator
+#if there is one, otherwise every dict*.csv in the folder is used, with bounds given by the lowest and highest mass it holds.
+#folder is a prefix, as for the dictionaries themselves, e.g. dictionarypath+"neg\\".
+def dictionarywindows(folder):
+    if os.path.isfile(folder+"manifest.csv"):
+        manifest = pd.read_csv(folder+"manifest.csv")
+        windows = [(folder+f, float(low), float(high)) for f, low, high in zip(manifest["file"],manifest["low"],manifest["high"])]
+    else:
+        windows = []
+        for filename in glob.glob(folder+"dict*.csv"):
+            x = loaddictionary(filename)
+            if len(x) > 0:
+                windows.append((filename, float(x["mass"][0]), float(x["mass"][-1])))
+    return sorted(windows, key=lambda x: x[1])
+
+#A mass index over a set of dictionary windows, given as (filename, low, high) which do not overlap. It works as one dictionary sorted by mass:
+#a lookup binary searches the window bounds and then the windows themselves, so it crosses window edges and costs the same at any mass.
+#Windows are only opened by loader when a lookup needs them (loaddictionary, or e.g. a cached version of it).
+def massindex(windows):
+    windows = sorted(windows, key=lambda x: x[1])
+    return {"files":[x[0] for x in windows],
+            "low":np.array([x[1] for x in windows],dtype="f8"),
+            "high":np.array([x[2] for x in windows],dtype="f8")}
+
+#The windows of a mass index which could hold formulae between low and high.
+def indexwindows(index, low, high):
+    return range(np.searchsorted(index["high"],low,side="left"),np.searchsorted(index["low"],high,side="right"))
+
+#The dictionary windows a mass index is missing for a set of peak masses, as a sorted list of (low, high).
+#Each peak outside every window gets the window of this width around it, at a multiple of the width (as 0-FormulaGenerator's windows are),
+#trimmed to the gap between the windows either side so it never overlaps them.
+def uncoveredwindows(index, peaks, width=100):
+    peaks = np.asarray(peaks,dtype="f8")
+    below = np.searchsorted(index["low"],peaks,side="right") - 1 #the window each peak is in, or the gap it is in is just above
+    covered = (below >= 0) & (peaks <= index["high"][np.maximum(below,0)]) if len(index["low"]) > 0 else np.zeros(len(peaks),dtype=bool)
+    missing = set()
+    for peak, w in zip(peaks[~covered].tolist(),below[~covered].tolist()):
+        low = math.floor(peak/width)*width
+        high = low + width
+        if w >= 0:
+            low = max(low,float(index["high"][w]))
+        if w + 1 < len(index["low"]):
+            high = min(high,float(index["low"][w+1]))
+        missing.add(tuple(int(x) if float(x).is_integer() else float(x) for x in (low,high)))
+    return sorted(missing)
+
+#As dictionaryrange, but over every window of a mass index.
+def indexrange(index, low, high, loader=loaddictionary):
+    parts = [dictionaryrange(loader(index["files"][w]),low,high) for w in indexwindows(index,low,high)]
+    if len(parts) == 1:
+        return parts[0]
+    if len(parts) == 0:
+        return np.zeros(0,dtype=formuladtype)
+    return np.concatenate(parts)
+
+#As massjoin, but over every window of a mass index. Each window is joined with the peaks whose threshold reaches it, and only those windows are opened.
+#Returns the peak positions, the matching formula records and their errors (ppm), ordered by peak then by formula mass.
+def indexjoin(index, peaks, threshold, threshppm, loader=loaddictionary, stats=None):
+    peaks = np.asarray(peaks,dtype="f8")
+    peakindex, records, errors = [], [], []
+    windows = indexwindows(index,peaks.min()-threshold,peaks.max()+threshold) if len(peaks) > 0 else []
+    for w in windows:
+        near = np.flatnonzero((peaks + threshold >= index["low"][w]) & (peaks - threshold <= index["high"][w]))
+        if len(near) == 0:
+            continue
+        x = loader(index["files"][w])
+        matches = massjoin(peaks[near],x["mass"],threshold,threshppm,stats)
+        peakindex.append(near[matches["peak"]])
+        records.append(np.asarray(x[matches["formula"]]))
+        errors.append(matches["error"])
+    if len(peakindex) == 0:
+        return np.zeros(0,dtype="i8"), np.zeros(0,dtype=formuladtype), np.zeros(0)
+    peakindex = np.concatenate(peakindex)
+    order = np.argsort(peakindex,kind="mergesort") #windows are joined in mass order, so this keeps each peak's formulae in mass order
+    return peakindex[order], np.concatenate(records)[order], np.concatenate(errors)[order]
+
+#The candidate formulae of a table of npeaks peaks, as typed arrays ordered by peak - the peak (its position in the table), the formula record
+#(see formuladtype) and the error (ppm). The candidates of peak i are rows offsets[i] to offsets[i+1]. looked flags the peaks already looked up.
+def newcandidates(npeaks):
+    return {"peak":np.zeros(0,dtype="i8"),"formula":np.zeros(0,dtype=formuladtype),"error":np.zeros(0),
+            "offsets":np.zeros(npeaks+1,dtype="i8"),"looked":np.zeros(npeaks,dtype=bool)}
+
+#Adds the candidates found for the peaks at positions (peak, formula and error as from indexjoin, with peak as positions in the table).
+#Each peak's candidates keep the order they were found in.
+def addcandidates(candidates, positions, peak, formula, error):
+    peak = np.concatenate((candidates["peak"],peak))
+    order = np.argsort(peak,kind="mergesort")
+    candidates["peak"] = peak[order]
+    candidates["formula"] = np.concatenate((candidates["formula"],formula))[order]
+    candidates["error"] = np.concatenate((candidates["error"],error))[order]
+    candidates["offsets"] = np.searchsorted(candidates["peak"],np.arange(len(candidates["offsets"])),side="left")
+    candidates["looked"][positions] = True
+    return candidates
+
+#The rows of the candidates of the peaks at positions, peak by peak in the order given.
+def peakcandidates(candidates, positions):
+    positions = np.asarray(positions,dtype="i8")
+    starts = candidates["offsets"][positions]
+    counts = candidates["offsets"][positions+1] - starts
+    return np.repeat(starts - np.cumsum(counts) + counts, counts) + np.arange(counts.sum())
+
+#Copies a typed array into a new block of shared memory, for other processes to read without copying it.
+#Returns the block (close and unlink it once every process is done with it) and the spec they attach to it with (see attacharray).
+def sharearray(x):
+    from multiprocessing import shared_memory
+    block = shared_memory.SharedMemory(create=True,size=max(x.nbytes,1))
+    np.ndarray(x.shape,dtype=x.dtype,buffer=block.buf)[...] = x
+    return block, (block.name, x.shape, x.dtype)
+
+#Attaches to a typed array shared by sharearray. Returns the block, which must be kept open while the array is in use, and the (read only) array.
+def attacharray(spec):
+    from multiprocessing import shared_memory
+    name, shape, dtype = spec
+    block = shared_memory.SharedMemory(name=name)
+    x = np.ndarray(shape,dtype=dtype,buffer=block.buf)
+    x.flags.writeable = False
+    return block, x
+
+#Puts every window of a mass index (opened with loader) into shared memory. Returns the blocks, and the specs of the windows by filename.
+def shareindex(index, loader=loaddictionary):
+    blocks, specs = [], {}
+    for filename in index["files"]:
+        block, specs[filename] = sharearray(loader(filename))
+        blocks.append(block)
+    return blocks, specs
+
+#One isotopologue match from isotopejoin - the positions of the peak and of the assigned hit, which isotopologue, and the error in ppm.
+isotopematchdtype = np.dtype([("peak","i8"),("hit","i8"),("isotope","i8"),("error","f8")])
+
+#Finds which peaks are isotopologues of which assigned hits, in one pass for all of the isotopologues. expected holds the mass of each isotopologue
+#(one row per isotopologue, one column per hit, NaN where the hit can't carry it) - as held in the dictionaries' isotopologue columns.
+#They are sorted and joined against the peaks within threshold (Da) and threshppm, just as peaks are matched to formulae (see massjoin).
+#The error is that of the peak against the expected isotopologue mass. Returns a typed array of matches (see isotopematchdtype), ordered by
+#isotopologue, then peak, then hit.
+def isotopejoin(peaks, expected, threshold, threshppm):
+    expected = np.asarray(expected,dtype="f8")
+    nhits = expected.shape[1] if expected.ndim == 2 else 0
+    expected = expected.ravel()
+    possible = np.flatnonzero(~np.isnan(expected))
+    order = possible[np.argsort(expected[possible],kind="mergesort")]
+    matches = massjoin(peaks,expected[order],threshold,np.inf)
+    position = order[matches["formula"]]
+    theoretical = expected[position]
+    error = ((np.asarray(peaks,dtype="f8")[matches["peak"]] - theoretical)/theoretical)*1000000
+    keep = np.abs(error) <= threshppm
+    isotopematches = np.zeros(np.count_nonzero(keep),dtype=isotopematchdtype)
+    isotopematches["peak"] = matches["peak"][keep]
+    isotopematches["hit"] = (position % max(1,nhits))[keep]
+    isotopematches["isotope"] = (position // max(1,nhits))[keep]
+    isotopematches["error"] = error[keep]
+    return isotopematches[np.lexsort((isotopematches["hit"],isotopematches["peak"],isotopematches["isotope"]))]
+
+#####
+# Stage metrics
+#####
+
+#Per stage measurements of a run (e.g. assigning one peaklist). Each stage (see startstage and endstage) records its number of calls, wall time (s),
+#peak memory (bytes allocated above what was in use when it started, as traced by tracemalloc), rows in and out, and candidates scanned.
+#Starts tracemalloc if it is not already running - finishmetrics stops it again, as tracing slows everything after it.
+def newstagemetrics(name):
+    started = not tracemalloc.is_tracing()
+    if started:
+        tracemalloc.start()
+    return {"name":name,"seconds":0.0,"peakmemory":0,"stages":{},"tracing":started,"open":[[None,time.perf_counter(),tracemalloc.get_traced_memory()[0],0]]}
+
+#Starts timing a stage. Stages can sit inside one another (e.g. a dictionary load inside a candidate lookup) - each is measured whole.
+#Does nothing if metrics is None, so it costs nothing when metrics are off.
+def startstage(metrics, stage):
+    if metrics is None:
+        return
+    current, peak = tracemalloc.get_traced_memory()
+    metrics["open"][-1][3] = max(metrics["open"][-1][3],peak) #the peak of the enclosing stage so far, before the peak is reset
+    tracemalloc.reset_peak()
+    metrics["open"].append([stage,time.perf_counter(),current,current])
+
+#Ends the latest stage started, adding its measurements to its totals in metrics.
+def endstage(metrics, rowsin=0, rowsout=0, candidates=0):
+    if metrics is None:
+        return
+    stage, start, startmemory, peak = metrics["open"].pop()
+    peak = max(peak,tracemalloc.get_traced_memory()[1])
+    metrics["open"][-1][3] = max(metrics["open"][-1][3],peak)
+    totals = metrics["stages"].setdefault(stage,{"calls":0,"seconds":0.0,"peakmemory":0,"rowsin":0,"rowsout":0,"candidates":0})
+    totals["calls"] = totals["calls"] + 1
+    totals["seconds"] = totals["seconds"] + time.perf_counter() - start
+    totals["peakmemory"] = max(totals["peakmemory"],peak - startmemory)
+    totals["rowsin"] = totals["rowsin"] + int(rowsin)
+    totals["rowsout"] = totals["rowsout"] + int(rowsout)
+    totals["candidates"] = totals["candidates"] + int(candidates)
+
+#Finishes a run's metrics - the total wall time and peak memory - and returns them ready to be written as json.
+def finishmetrics(metrics):
+    stage, start, startmemory, peak = metrics.pop("open")[0]
+    metrics["seconds"] = time.perf_counter() - start
+    metrics["peakmemory"] = max(peak,tracemalloc.get_traced_memory()[1]) - startmemory
+    if metrics.pop("tracing"): #newstagemetrics started tracemalloc, so stop it
+        tracemalloc.stop()
+    return metrics
+
+#Sums the metrics of several runs (e.g. a batch of peaklists) into one summary, with each run's total alongside.
+def summarisemetrics(runs):
+    summary = {"runs":len(runs),"seconds":0.0,"peakmemory":0,"stages":{},
+               "byrun":[{"name":x["name"],"seconds":x["seconds"],"peakmemory":x["peakmemory"]} for x in runs]}
+    for x in runs:
+        summary["seconds"] = summary["seconds"] + x["seconds"]
+        summary["peakmemory"] = max(summary["peakmemory"],x["peakmemory"])
+        for stage, y in x["stages"].items():
+            totals = summary["stages"].setdefault(stage,{"calls":0,"seconds":0.0,"peakmemory":0,"rowsin":0,"rowsout":0,"candidates":0})
+            for field in totals:
+                totals[field] = max(totals[field],y[field]) if field == "peakmemory" else totals[field] + y[field]
+    return summary
+
+#A printable table of the stages in some metrics.
+def stagemetricsreport(metrics):
+    lines = []
+    for stage, x in metrics["stages"].items():
+        lines.append("    " + stage + ": " + str(x["calls"]) + " calls, " + str(round(x["seconds"],3)) + " s, peak " + str(round(x["peakmemory"]/1e6,1)) + " MB, rows "
+                     + str(x["rowsin"]) + " in " + str(x["rowsout"]) + " out, " + str(x["candidates"]) + " candidates")
+    return "\n".join(lines)
+
+#####
+# Formula dictionary cache
+#####
+
+#Version of the dictionary artifacts. It is part of the cache key, so a change to what we write out never picks up an old artifact.
+formulacacheversion = 4
+
+#This is the content address of a dictionary window - a hash of everything which decides which formulae it holds:
+#the mode, the window, the elemental limits, the atomic masses and abundances, the ratio rules and the isotopes of the isotopologue columns.
+def dictionarykey(mode, low, high, limits, chemdict):
+    keydata = {"mode":mode,
+               "low":low,
+               "high":high,
+               "limits":[int(x) for x in limits],
+               "chemdict":{x:list(chemdict[x]) for x in chemdict},
+               "rules":{x:formularules[x] for x in formularules},
+               "isotopes":{x:list(isotopedict[x]) for x in set(isotope for name, isotope, count in isotopologues)},
+               "version":formulacacheversion}
+    return hashlib.sha256(json.dumps(keydata,sort_keys=True).encode("utf-8")).hexdigest()
+
+#Where a dictionary window lives in the cache. The window is in the file name only to make the cache easier to browse.
+def cachedictionarypath(cachepath, mode, low, high, limits, chemdict):
+    return os.path.join(cachepath, mode[:3], "dict"+str(low)+"-"+dictionarykey(mode, low, high, limits, chemdict)+".csv")
+
+#Returns the cached dictionary window for these limits, or None if it has not been generated yet.
+def cacheddictionary(cachepath, mode, low, high, limits, chemdict):
+    filename = cachedictionarypath(cachepath, mode, low, high, limits, chemdict)
+    if os.path.isfile(filename):
+        return filename
+    return None
+
+#Saves a dictionary window into the cache, by copying the csv dictionary (and the binary dictionary, if there is one).
+#Each is copied to a temporary file first and then moved into place, so an interrupted run can never leave a half written artifact under a valid key.
+#The csv goes in last, as it is the file cacheddictionary looks for.
+def savecacheddictionary(csvfile, npyfile, cachepath, mode, low, high, limits, chemdict):
+    filename = cachedictionarypath(cachepath, mode, low, high, limits, chemdict)
+    make_sure_path_exists(os.path.dirname(filename))
+    if npyfile is not None:
+        shutil.copyfile(npyfile,binarydictionarypath(filename)+".tmp")
+        os.replace(binarydictionarypath(filename)+".tmp",binarydictionarypath(filename))
+    shutil.copyfile(csvfile,filename+".tmp")
+    os.replace(filename+".tmp",filename)
+    if npyfile is not None: #so the binary dictionary is not taken to be older than the csv, see loaddictionary
+        os.utime(binarydictionarypath(filename))
+    return filename
+
+#Generates one dictionary window in this process, as 0-FormulaGenerator does (the vectorised, mass bounded engine, with elementallimits and an
+#external merge sort), and saves it into the formula cache. Returns the cached csv dictionary - its binary dictionary is alongside it.
+def generatewindow(mode, low, high, chemdict, cachepath, chunkrows=1000000, tmpdir=None):
+    import tempfile
+    limits = elementallimits(low,high,mode)
+    runpath = tempfile.mkdtemp(dir=tmpdir)
+    try:
+        chunks = vector_form_chunks(*limits, low, high, mode, chemdict, chunkrows, True)
+        runs = sortedruns(chunks,chunkrows,runpath,mode[:3]+"dict"+str(low))
+        csvfile = os.path.join(runpath,"dict"+str(low)+".csv")
+        npyfile = os.path.join(runpath,"dict"+str(low)+".npy")
+        writedictionary(mergeruns(runs,chunkrows),runrows(runs),csvfile,npyfile)
+        return savecacheddictionary(csvfile,npyfile,cachepath,mode,low,high,limits,chemdict)
+    finally:
+        shutil.rmtree(runpath,ignore_errors=True)
+
+#####
+# Candidate cache
+#####
+
+#One raw candidate - the position of the peak in the peak list, the error in ppm, and the formula it may be.
+candidatedtype = np.dtype([("peak","i8"),("error","f8"),("formula",formuladtype)])
+
+#This is the content address of a peak list's raw candidates - a hash of the mode, the peak masses, the tolerances they were found within,
+#and the dictionary windows they were found in (their bounds, sizes and modification times), so new dictionaries are never matched to old candidates.
+#A window is judged by its csv where there is one, as the binary dictionary alongside it may be (re)written from the csv while the candidates are found.
+def candidatekey(mode, peaks, index, threshold, threshppm):
+    windows = []
+    for f, low, high in zip(index["files"],index["low"],index["high"]):
+        stored = f if os.path.isfile(f) else binarydictionarypath(f)
+        windows.append([f,float(low),float(high),os.path.getsize(stored),os.path.getmtime(stored)])
+    keydata = {"mode":mode,
+               "peaks":hashlib.sha256(np.ascontiguousarray(peaks,dtype="f8").tobytes()).hexdigest(),
+               "threshold":threshold,
+               "threshppm":threshppm,
+               "windows":windows,
+               "version":formulacacheversion}
+    return hashlib.sha256(json.dumps(keydata,sort_keys=True).encode("utf-8")).hexdigest()
+
+#Where a peak list's raw candidates live in the candidate cache.
+def candidatecachepath(cachepath, mode, peaks, index, threshold, threshppm):
+    return os.path.join(cachepath, mode[:3], "candidates-"+candidatekey(mode, peaks, index, threshold, threshppm)+".npy")
+
+#Every peak-formula pair within threshold (Da) and threshppm, over a mass index (see indexjoin), as a typed array (see candidatedtype).
+def candidatejoin(index, peaks, threshold, threshppm, loader=loaddictionary, stats=None):
+    peakindex, records, errors = indexjoin(index, peaks, threshold, threshppm, loader, stats)
+    x = np.zeros(len(peakindex),dtype=candidatedtype)
+    x["peak"] = peakindex
+    x["error"] = errors
+    x["formula"] = records
+    return x
+
+#Narrows raw candidates down to a tighter threshold (Da) and threshppm - exactly the pairs indexjoin would find with them, in the same order.
+def filtercandidates(x, peaks, threshold, threshppm):
+    peaks = np.asarray(peaks,dtype="f8")[x["peak"]]
+    mass = x["formula"]["mass"]
+    return x[(mass >= peaks - threshold) & (mass <= peaks + threshold) & (np.abs(x["error"]) <= threshppm)]
+
+#Loads cached raw candidates, or returns None if there are none.
+def loadcandidates(filename):
+    if os.path.isfile(filename):
+        return np.load(filename)
+    return None
+
+#Saves raw candidates into the candidate cache. Written to a temporary file and moved into place, as for binary dictionaries.
+def savecandidates(x, filename):
+    make_sure_path_exists(os.path.dirname(filename))
+    with open(filename+".tmp","wb") as f:
+        np.save(f,np.ascontiguousarray(x,dtype=candidatedtype))
+    os.replace(filename+".tmp",filename)
+    return filename
+
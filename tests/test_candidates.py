@@ -0,0 +1,19 @@
+#The candidate cache key (FTPM.candidatekey) must not change when a csv dictionary is converted to a binary one while its candidates are found.
+import os, sys, shutil, time
+import numpy as np
+sys.path.insert(0,os.path.join(os.path.dirname(os.path.abspath(__file__)),".."))
+import FTMSVizProcessingModule as FTPM
+
+dictionaries = os.path.join(os.path.dirname(os.path.abspath(__file__)),"..","MassToFormula","dictionaries","neg")
+
+def test_key_survives_conversion(tmp_path):
+    shutil.copyfile(os.path.join(dictionaries,"dict300.csv"),str(tmp_path / "dict300.csv"))
+    folder = str(tmp_path) + os.sep
+    FTPM.writemanifest(folder+"manifest.csv",[("dict300.csv",300,400,0)])
+    index = FTPM.massindex(FTPM.dictionarywindows(folder))
+    peaks = np.array([301.0, 350.1, 399.2])
+    before = FTPM.candidatekey("negative",peaks,index,0.005,5.0)
+    time.sleep(0.01)
+    FTPM.candidatejoin(index,peaks,0.005,5.0)
+    assert os.path.isfile(str(tmp_path / "dict300.npy")) #the join converted the csv
+    assert FTPM.candidatekey("negative",peaks,index,0.005,5.0) == before
@@ -0,0 +1,24 @@
+#Generating both modes in parallel into one temporary folder (as 0-FormulaGenerator does with sharedneutral = False) must give the same
+#dictionaries as generating each mode on its own.
+import os, sys
+import numpy as np
+sys.path.insert(0,os.path.join(os.path.dirname(os.path.abspath(__file__)),".."))
+import FTMSVizProcessingModule as FTPM
+
+def modewindows(mode):
+    return [(low, low+100, FTPM.elementallimits(low,low+100,mode)) for low in (200,400)]
+
+def merged(runs):
+    return [np.concatenate(list(FTPM.mergeruns(x,100000))) for x in runs]
+
+def test_both_modes_share_a_tmpdir(tmp_path):
+    alone = {}
+    for mode in ("negative","positive"):
+        os.mkdir(str(tmp_path / mode))
+        alone[mode] = merged(FTPM.parallel_form_runs(modewindows(mode),mode,FTPM.chemdict,str(tmp_path / mode),2,100000))
+    os.mkdir(str(tmp_path / "both"))
+    runs = {mode:FTPM.parallel_form_runs(modewindows(mode),mode,FTPM.chemdict,str(tmp_path / "both"),2,100000) for mode in ("negative","positive")}
+    for mode in ("negative","positive"):
+        for x, y in zip(merged(runs[mode]),alone[mode]):
+            assert len(x) > 0
+            assert x.tobytes() == y.tobytes()
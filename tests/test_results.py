@@ -0,0 +1,26 @@
+#Round trip of the parquet results file (FTPM.writeresults and FTPM.readresults), including tables with no rows.
+import os, sys
+import pandas as pd
+sys.path.insert(0,os.path.join(os.path.dirname(os.path.abspath(__file__)),".."))
+import FTMSVizProcessingModule as FTPM
+
+def hitstable():
+    return pd.DataFrame({"Exp. m/z":[300.1,301.2],"Theor. Mass":[300.1001,301.2002],"Error":[0.3,-0.6],"Abundance":[1000,2000],"DBE":[4.0,5.0],
+                         "C":[10,11],"H":[14,16],"N":[0,1],"O":[5,4],"S":[0,0],"Formula":["C10H15O5","C11H17N1O4"],"HeteroClass":["O5","N1O4"]},index=[3,7])
+
+def test_empty_isohits_and_nohits(tmp_path):
+    hits = hitstable()
+    isohits = pd.DataFrame(columns=["Exp. m/z","Theor. Mass","Error","Abundance","Signal2Noise","DBE","C","H","N","O","S","13C","18O","34S","15N","Formula","HeteroClass"])
+    nohits = pd.DataFrame(columns=["Exp. m/z","Abundance"])
+    filename = str(tmp_path / "sample-results.parquet")
+    FTPM.writeresults(filename,hits,isohits,nohits)
+    readhits = FTPM.readresults(filename,"hit")
+    assert list(readhits.columns) == list(hits.columns)
+    assert list(readhits.index) == [3,7]
+    assert readhits["Formula"].tolist() == hits["Formula"].tolist()
+    assert readhits["C"].dtype == "int64"
+    for status, x in (("isohit",isohits),("nohit",nohits)):
+        data = FTPM.readresults(filename,status)
+        assert len(data) == 0
+        assert list(data.columns) == list(x.columns)
+    assert list(FTPM.readoutput(filename,"nohit").columns) == ["Exp. m/z","Abundance"]